@@ -0,0 +1,515 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Local stand-ins for the services a feed refresh talks to, so that
+    benchmarks can run offline: a Nuxeo REST API serving synthetic
+    collections, the collection registry API, and a path-style S3 endpoint.
+
+    Services.start() runs all three in a separate process, so that serving
+    requests doesn't compete with the code being timed for the GIL.
+    Services.media_json_stash() stands in for s3stash's NuxeoStashMediaJson. """
+
+import re
+import json
+import time
+import random
+import hashlib
+import threading
+import multiprocessing
+import urlparse
+import urllib
+import urllib2
+import BaseHTTPServer
+import SocketServer
+from datetime import datetime, timedelta
+from email.utils import formatdate
+from xml.sax.saxutils import escape
+
+NUXEO_API_PATH = '/Nuxeo/site/api/v1'
+REGISTRY_API_PATH = '/api/v1/'
+COLLECTION_PATH = '/asset-library/UCX/benchmark_{}'
+OBJECT_TYPE = 'SampleCustomPicture'
+FOLDER_TYPE = 'Organization'
+START_DATE = datetime(2016, 1, 1)
+QUERY_CACHE_SIZE = 16
+
+class SyntheticCollections():
+    ''' Nuxeo documents for synthetic collections, generated on demand from
+        their uids rather than held in memory. Every complex_every-th object
+        in a collection has the given number of components. uids look like
+        c<collection>, c<collection>-o<object> and c<collection>-o<object>-<component> '''
+
+    def __init__(self, sizes, components=3, complex_every=3):
+        self.sizes = sizes
+        self.components = components
+        self.complex_every = complex_every
+
+    def component_count(self, index):
+        return self.components if index % self.complex_every == 0 else 0
+
+    def _parse_uid(self, uid):
+        ''' (collection id, object index or None, component index or None), or None if no such document '''
+        match = re.match(r'^c([^-]+)(?:-o(\d+)(?:-(\d+))?)?$', uid)
+        if not match or match.group(1) not in self.sizes:
+            return None
+        collection_id = match.group(1)
+        index = int(match.group(2)) if match.group(2) else None
+        component = int(match.group(3)) if match.group(3) else None
+        if index is not None and index >= self.sizes[collection_id]:
+            return None
+        if component is not None and component >= self.component_count(index):
+            return None
+        return collection_id, index, component
+
+    def _uid(self, collection_id, index=None, component=None):
+        uid = 'c{}'.format(collection_id)
+        if index is not None:
+            uid = '{}-o{:07d}'.format(uid, index)
+        if component is not None:
+            uid = '{}-{:03d}'.format(uid, component)
+        return uid
+
+    def _path(self, collection_id, index=None, component=None):
+        path = COLLECTION_PATH.format(collection_id)
+        if index is not None:
+            path = '{}/object_{}'.format(path, index)
+        if component is not None:
+            path = '{}/component_{}'.format(path, component)
+        return path
+
+    def _modified(self, index=None, component=None):
+        ''' objects are modified a minute apart; components an hour after their parent '''
+        modified = START_DATE
+        if index is not None:
+            modified = modified + timedelta(minutes=index)
+        if component is not None:
+            modified = modified + timedelta(hours=1, seconds=component)
+        return modified
+
+    def document(self, uid):
+        ''' full metadata for a document, as the Nuxeo REST API returns it with all schemas, or None '''
+        parsed = self._parse_uid(uid)
+        if parsed is None:
+            return None
+        collection_id, index, component = parsed
+
+        path = self._path(collection_id, index, component)
+        modified = self._modified(index, component).strftime('%Y-%m-%dT%H:%M:%S.00Z')
+        if index is None:
+            return {'entity-type': 'document', 'uid': uid, 'path': path, 'type': FOLDER_TYPE,
+                    'title': 'Benchmark collection {}'.format(collection_id), 'lastModified': modified,
+                    'isTrashed': False, 'properties': {'dc:title': 'Benchmark collection {}'.format(collection_id)}}
+
+        title = 'Object {}'.format(index) if component is None else 'Component {} of object {}'.format(component, index)
+        filename = '{}.tif'.format(uid)
+        properties = {
+            'dc:title': title,
+            'dc:modified': modified,
+            'ucldc_schema:creator': [{'name': 'Creator {}'.format(index % 100)}] if component is None else [],
+            'ucldc_schema:date': [{'date': '19{:02d}'.format(index % 100)}] if component is None else [],
+            'ucldc_schema:identifier': 'ark:/13030/bench{}'.format(index) if component is None and index % 2 else None,
+            'ucldc_schema:collection': ['https://registry.cdlib.org/api/v1/collection/{}/'.format(collection_id)] if component is None else [],
+            'file:content': {'name': filename,
+                             'data': 'https://nuxeo.cdlib.org/nuxeo/nxfile/default/{}/file:content/{}'.format(uid, filename),
+                             'digest': hashlib.md5(uid).hexdigest(),
+                             'mime-type': 'image/tiff',
+                             'length': 1024 * 1024},
+            'files:files': [],
+            'extra_files:file': [{'blob': {'name': '{}.dng'.format(uid),
+                                           'data': 'https://nuxeo.cdlib.org/nuxeo/nxfile/default/{}/extra_files:file/0/blob/{}.dng'.format(uid, uid),
+                                           'digest': hashlib.md5(uid + '.dng').hexdigest()}}]}
+
+        return {'entity-type': 'document', 'uid': uid, 'path': path, 'type': OBJECT_TYPE, 'title': title,
+                'lastModified': modified, 'isTrashed': False, 'properties': properties}
+
+    def uid_for_path(self, path):
+        for collection_id in self.sizes:
+            base = self._path(collection_id)
+            if path.rstrip('/') == base:
+                return self._uid(collection_id)
+            match = re.match(r'^{}/object_(\d+)(?:/component_(\d+))?$'.format(re.escape(base)), path.rstrip('/'))
+            if match:
+                uid = self._uid(collection_id, int(match.group(1)), int(match.group(2)) if match.group(2) else None)
+                if self._parse_uid(uid):
+                    return uid
+        return None
+
+    def children(self, uid):
+        ''' (uid, type, modified) for the direct children of a document '''
+        parsed = self._parse_uid(uid)
+        if parsed is None:
+            return
+        collection_id, index, component = parsed
+        if index is None:
+            for i in xrange(self.sizes[collection_id]):
+                yield self._uid(collection_id, i), OBJECT_TYPE, self._modified(i)
+        elif component is None:
+            for j in xrange(self.component_count(index)):
+                yield self._uid(collection_id, index, j), OBJECT_TYPE, self._modified(index, j)
+
+    def descendants(self, uid):
+        ''' (uid, type, modified) for everything under a document, parents before their components '''
+        for child in self.children(uid):
+            yield child
+            for descendant in self.descendants(child[0]):
+                yield descendant
+
+class NuxeoQuery():
+    ''' the subset of NXQL used by merritt_atom, deepharvest and refresh_feeds:
+        SELECT * FROM <types> WHERE ecm:path STARTSWITH / ecm:parentId = /
+        dc:modified >= TIMESTAMP conditions, joined by AND '''
+
+    def __init__(self, query):
+        self.query = query
+        match = re.search(r"FROM\s+(.+?)\s+WHERE", query, re.I)
+        self.types = set(t.strip() for t in match.group(1).split(',')) if match else set(['Document'])
+
+        match = re.search(r"ecm:path\s+STARTSWITH\s+'((?:[^'\\]|\\.)*)'", query)
+        self.path = match.group(1).replace("\\'", "'") if match else None
+
+        match = re.search(r"ecm:parentId\s*=\s*'([^']*)'", query)
+        self.parent_id = match.group(1) if match else None
+
+        match = re.search(r"dc:modified\s*>=\s*TIMESTAMP\s+'([^']*)'", query)
+        self.modified_since = self._parse_timestamp(match.group(1)) if match else None
+
+    def _parse_timestamp(self, timestamp):
+        return datetime.strptime(timestamp.replace('T', ' ')[:19], '%Y-%m-%d %H:%M:%S')
+
+    def uids(self, collections):
+        ''' uids of matching documents, in document order '''
+        if self.parent_id is not None:
+            candidates = collections.children(self.parent_id)
+        elif self.path is not None:
+            candidates = collections.descendants(collections.uid_for_path(self.path) or '')
+        else:
+            candidates = []
+
+        uids = []
+        for uid, doc_type, modified in candidates:
+            if 'Document' not in self.types and doc_type not in self.types:
+                continue
+            if self.modified_since and modified < self.modified_since:
+                continue
+            uids.append(uid)
+        return uids
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    ''' keep-alive handler base; request logging is off so it doesn't skew timings '''
+    protocol_version = 'HTTP/1.1'
+    # send each response in one write, rather than a packet per header
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def respond(self, status, body='', headers=None, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def read_body(self):
+        # botocore asks for 100-continue before sending a body; BaseHTTPServer doesn't answer it
+        if self.headers.get('Expect', '').lower() == '100-continue':
+            self.wfile.write('HTTP/1.1 100 Continue\r\n\r\n')
+            self.wfile.flush()
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else ''
+
+class NuxeoHandler(Handler):
+    ''' GET /id/<uid>, /path/<path> and /path/@search for the synthetic collections.
+        error_rate of requests fail with a 503, as an overloaded Nuxeo would '''
+    collections = None
+    queries = None
+    error_rate = 0
+    lock = threading.Lock()
+
+    def do_GET(self):
+        if self.error_rate and random.random() < self.error_rate:
+            return self.respond(503, json.dumps({'entity-type': 'exception', 'status': 503}), headers={'Retry-After': '1'})
+
+        url = urlparse.urlsplit(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        path = urllib.unquote(url.path)
+        if not path.startswith(NUXEO_API_PATH):
+            return self.not_found(path)
+        path = path[len(NUXEO_API_PATH):]
+
+        if path == '/path/@search':
+            return self.search(params)
+        if path.startswith('/id/'):
+            document = self.collections.document(path[len('/id/'):])
+        elif path.startswith('/path/'):
+            uid = self.collections.uid_for_path(path[len('/path'):])
+            document = self.collections.document(uid) if uid else None
+        else:
+            document = None
+
+        if document is None:
+            return self.not_found(path)
+        self.respond(200, json.dumps(document))
+
+    def not_found(self, path):
+        self.respond(404, json.dumps({'entity-type': 'exception', 'status': 404, 'message': path}))
+
+    def _query_uids(self, query):
+        ''' matching uids for a query, kept for the following pages of the same query '''
+        with self.lock:
+            if query in self.queries:
+                return self.queries[query]
+        uids = NuxeoQuery(query).uids(self.collections)
+        with self.lock:
+            if len(self.queries) >= QUERY_CACHE_SIZE:
+                self.queries.pop(next(iter(self.queries)))
+            self.queries[query] = uids
+        return uids
+
+    def search(self, params):
+        uids = self._query_uids(params.get('query', ''))
+        page_size = int(params.get('pageSize', 50))
+        page_index = int(params.get('currentPageIndex', 0))
+        page = uids[page_index * page_size:(page_index + 1) * page_size]
+
+        number_of_pages = (len(uids) + page_size - 1) // page_size if page_size else 1
+        self.respond(200, json.dumps({
+            'entity-type': 'documents',
+            'isPaginable': True,
+            'resultsCount': len(uids),
+            'pageSize': page_size,
+            'currentPageIndex': page_index,
+            'numberOfPages': number_of_pages,
+            'isNextPageAvailable': page_index + 1 < number_of_pages,
+            'entries': [self.collections.document(uid) for uid in page]}))
+
+class RegistryHandler(Handler):
+    ''' GET collection/ (paged list) and collection/<id>/ from the registry API '''
+    collections = None
+
+    def record(self, collection_id):
+        return {'resource_uri': '{}collection/{}/'.format(REGISTRY_API_PATH, collection_id),
+                'name': 'Benchmark collection {}'.format(collection_id),
+                'harvest_type': 'NUX',
+                'merritt_id': 'ark:/13030/m5bench{}'.format(collection_id),
+                'merritt_extra_data': COLLECTION_PATH.format(collection_id)}
+
+    def do_GET(self):
+        url = urlparse.urlsplit(self.path)
+        params = dict(urlparse.parse_qsl(url.query))
+        path = url.path[len(REGISTRY_API_PATH):] if url.path.startswith(REGISTRY_API_PATH) else ''
+
+        if path == 'collection/':
+            collection_ids = sorted(self.collections.sizes)
+            limit = int(params.get('limit', 20))
+            offset = int(params.get('offset', 0))
+            return self.respond(200, json.dumps({
+                'meta': {'limit': limit, 'offset': offset, 'total_count': len(collection_ids)},
+                'objects': [self.record(collection_id) for collection_id in collection_ids[offset:offset + limit]]}))
+
+        match = re.match(r'^collection/([^/]+)/$', path)
+        if match and match.group(1) in self.collections.sizes:
+            return self.respond(200, json.dumps(self.record(match.group(1))))
+
+        self.respond(404, json.dumps({'error': 'not found'}))
+
+class S3Handler(Handler):
+    ''' path-style S3: HEAD/GET/PUT object and multipart upload, held in memory '''
+    objects = None
+    uploads = None
+    lock = threading.Lock()
+
+    def _location(self):
+        url = urlparse.urlsplit(self.path)
+        bucket, _, key = urllib.unquote(url.path).lstrip('/').partition('/')
+        return bucket, key, dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+
+    def error(self, status, code):
+        body = '<?xml version="1.0" encoding="UTF-8"?><Error><Code>{}</Code><Message>{}</Message></Error>'.format(code, code)
+        self.respond(status, body, content_type='application/xml')
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        bucket, key, params = self._location()
+        with self.lock:
+            obj = self.objects.get((bucket, key))
+        if obj is None:
+            return self.error(404, 'NoSuchKey')
+
+        headers = {'ETag': obj['etag'], 'Last-Modified': obj['last_modified']}
+        for name, value in obj['metadata'].items():
+            headers['x-amz-meta-{}'.format(name)] = value
+        if obj['content_encoding']:
+            headers['Content-Encoding'] = obj['content_encoding']
+        self.respond(200, obj['body'], headers, content_type=obj['content_type'])
+
+    def _store(self, bucket, key, body, headers):
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        obj = {'body': body,
+               'etag': etag,
+               'last_modified': formatdate(time.time(), usegmt=True),
+               'content_type': headers.get('Content-Type', 'binary/octet-stream'),
+               'content_encoding': headers.get('Content-Encoding'),
+               'metadata': dict((name[len('x-amz-meta-'):], value) for name, value in headers.items()
+                                if name.lower().startswith('x-amz-meta-'))}
+        with self.lock:
+            self.objects[(bucket, key)] = obj
+        return etag
+
+    def do_PUT(self):
+        bucket, key, params = self._location()
+        body = self.read_body()
+        if 'uploadId' in params:
+            with self.lock:
+                upload = self.uploads.get(params['uploadId'])
+                if upload is not None:
+                    upload['parts'][int(params['partNumber'])] = body
+            if upload is None:
+                return self.error(404, 'NoSuchUpload')
+            return self.respond(200, headers={'ETag': '"{}"'.format(hashlib.md5(body).hexdigest())})
+
+        etag = self._store(bucket, key, body, self.headers)
+        self.respond(200, headers={'ETag': etag})
+
+    def do_POST(self):
+        bucket, key, params = self._location()
+        self.read_body()
+        if 'uploads' in params:
+            with self.lock:
+                upload_id = str(len(self.uploads) + 1)
+                self.uploads[upload_id] = {'headers': dict(self.headers.items()), 'parts': {}}
+            return self.respond(200, '<?xml version="1.0" encoding="UTF-8"?><InitiateMultipartUploadResult>'
+                                     '<Bucket>{}</Bucket><Key>{}</Key><UploadId>{}</UploadId>'
+                                     '</InitiateMultipartUploadResult>'.format(escape(bucket), escape(key), upload_id),
+                                content_type='application/xml')
+
+        if 'uploadId' in params:
+            with self.lock:
+                upload = self.uploads.pop(params['uploadId'], None)
+            if upload is None:
+                return self.error(404, 'NoSuchUpload')
+            body = ''.join(upload['parts'][number] for number in sorted(upload['parts']))
+            etag = self._store(bucket, key, body, upload['headers'])
+            return self.respond(200, '<?xml version="1.0" encoding="UTF-8"?><CompleteMultipartUploadResult>'
+                                     '<Bucket>{}</Bucket><Key>{}</Key><ETag>{}</ETag>'
+                                     '</CompleteMultipartUploadResult>'.format(escape(bucket), escape(key), escape(etag)),
+                                content_type='application/xml')
+
+        self.error(400, 'InvalidRequest')
+
+class MediaJsonStash():
+    ''' stand-in for s3stash's NuxeoStashMediaJson: walks the object in the
+        Nuxeo stand-in, as the library does in Nuxeo, and puts its media.json
+        on the S3 stand-in with the boto3 client s3 '''
+
+    def __init__(self, nuxeo_api, s3, path, bucket):
+        self.nuxeo_api = nuxeo_api
+        self.s3 = s3
+        self.path = path
+        self.bucket = bucket
+
+    def _get(self, path, params=None):
+        url = '{}{}'.format(self.nuxeo_api, urllib.quote(path))
+        if params:
+            url = '{}?{}'.format(url, urllib.urlencode(params))
+        return json.load(urllib2.urlopen(url))
+
+    def _media_json_node(self, doc):
+        return {'label': doc['title'], 'id': doc['uid'], 'href': doc['properties']['file:content']['data']}
+
+    def nxstashref(self):
+        media_json = self._media_json_node(self._get('/path{}'.format(self.path)))
+        query = "SELECT * FROM Document WHERE ecm:path STARTSWITH '{}' AND ecm:isTrashed = 0".format(self.path.replace("'", "\\'"))
+        components = []
+        page_index = 0
+        while True:
+            page = self._get('/path/@search', {'query': query, 'currentPageIndex': page_index})
+            components.extend(self._media_json_node(c) for c in page['entries'])
+            if not page['isNextPageAvailable']:
+                break
+            page_index = page_index + 1
+        if components:
+            media_json['structMap'] = components
+
+        bucket, _, prefix = self.bucket.partition('/')
+        key = '{}/{}-media.json'.format(prefix, media_json['id']) if prefix else '{}-media.json'.format(media_json['id'])
+        self.s3.put_object(Bucket=bucket, Key=key, Body=json.dumps(media_json), ContentType='application/json')
+        return {'stashed': True}
+
+def serve(sizes, components, complex_every, error_rate, ports):
+    ''' run the three services until the process is terminated, putting their ports on the ports queue '''
+    # this process only runs the services, so the handlers' shared state can live on the classes
+    collections = SyntheticCollections(sizes, components, complex_every)
+    NuxeoHandler.collections = collections
+    NuxeoHandler.queries = {}
+    NuxeoHandler.error_rate = error_rate
+    RegistryHandler.collections = collections
+    S3Handler.objects = {}
+    S3Handler.uploads = {}
+
+    servers = [ThreadedHTTPServer(('127.0.0.1', 0), handler) for handler in (NuxeoHandler, RegistryHandler, S3Handler)]
+    threads = [threading.Thread(target=server.serve_forever) for server in servers]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    ports.put([server.server_address[1] for server in servers])
+
+    for thread in threads:
+        thread.join()
+
+class Services():
+    ''' Nuxeo, registry and S3 stand-ins running in a child process. sizes is
+        a dict of registry collection id -> number of objects; nuxeo_error_rate
+        the share of Nuxeo requests to fail '''
+
+    def __init__(self, sizes, components=3, complex_every=3, nuxeo_error_rate=0):
+        self.sizes = sizes
+        self.components = components
+        self.complex_every = complex_every
+        self.nuxeo_error_rate = nuxeo_error_rate
+        self._process = None
+
+    def start(self):
+        ports = multiprocessing.Queue()
+        self._process = multiprocessing.Process(target=serve, args=(self.sizes, self.components, self.complex_every, self.nuxeo_error_rate, ports))
+        self._process.daemon = True
+        self._process.start()
+        nuxeo_port, registry_port, s3_port = ports.get(timeout=30)
+
+        self.nuxeo_api = 'http://127.0.0.1:{}{}'.format(nuxeo_port, NUXEO_API_PATH)
+        self.registry_api = 'http://127.0.0.1:{}{}'.format(registry_port, REGISTRY_API_PATH)
+        self.s3_endpoint = 'http://127.0.0.1:{}'.format(s3_port)
+        return self
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def media_json_stash(self, s3):
+        ''' stand-in for NuxeoStashMediaJson(path, bucket, region) that stashes
+            with these services, putting media.json with the boto3 client s3 '''
+        def stash(path, bucket, region, **kwargs):
+            return MediaJsonStash(self.nuxeo_api, s3, path, bucket)
+        return stash
+
+    def collection_path(self, collection_id):
+        return COLLECTION_PATH.format(collection_id)
+
+    def write_pynuxrc(self, filepath):
+        ''' pynux config pointing at the Nuxeo stand-in, returning all document schemas '''
+        with open(filepath, 'w') as f:
+            f.write('[nuxeo_account]\nuser = benchmark\npassword = benchmark\n\n'
+                    '[rest_api]\nbase = {}\nX-NXDocumentProperties = *\n'.format(self.nuxeo_api))
+        return filepath
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" Time feed creation end to end against local stand-ins for Nuxeo, the
+    registry and S3 (see fake_services.py), for synthetic collections of
+    increasing size: MerrittAtom.process_feed, _write_feed and
+    has_duplicates on a single collection, and the refresh_feeds loop over
+    several collections adding up to the same number of objects.
+
+    Needs the repo's own dependencies (pynux, deepharvest, boto3) but no
+    network access or credentials. media.json is stashed by a stand-in for
+    s3stash's NuxeoStashMediaJson, which would go to Nuxeo and S3 proper.
+
+    Run from the repo root: python benchmarks/offline_refresh.py """
+
+import sys, os
+import argparse
+import json
+import logging
+import platform
+import shutil
+import tempfile
+import time
+from lxml import etree
+
+sys.path.insert(0, os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)))
+
+# boto3 needs credentials to sign requests, even for the S3 stand-in
+os.environ.setdefault('AWS_ACCESS_KEY_ID', 'benchmark')
+os.environ.setdefault('AWS_SECRET_ACCESS_KEY', 'benchmark')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+import merritt_atom
+from merritt_atom import MerrittAtom
+from clients import Clients
+from registry import RegistryClient
+import refresh_feeds
+from fake_services import Services
+
+SIZES = [1000, 10000, 100000]
+SINGLE_COLLECTION_ID = '1'
+
+def timed(function, *args, **kwargs):
+    ''' (result, elapsed seconds) '''
+    started = time.time()
+    result = function(*args, **kwargs)
+    return result, time.time() - started
+
+def result(benchmark, size, elapsed, **extra):
+    measurement = {'benchmark': benchmark, 'objects': size, 'seconds': round(elapsed, 4),
+                   'usec_per_object': round(elapsed / size * 1e6, 3) if size else None}
+    measurement.update(extra)
+    print json.dumps(measurement)
+    return measurement
+
+def benchmark_size(size, argv, workdir):
+    ''' run the benchmarks for one collection size against a fresh set of services '''
+    collection_size = max(size // argv.collections, 1)
+    sizes = {SINGLE_COLLECTION_ID: size}
+    refresh_ids = ['{}{:03d}'.format(size, n) for n in range(argv.collections)]
+    for collection_id in refresh_ids:
+        sizes[collection_id] = collection_size
+
+    services = Services(sizes, argv.components, argv.complex_every, argv.nuxeo_error_rate).start()
+    stash_media_json = merritt_atom.NuxeoStashMediaJson
+    merritt_atom.NuxeoStashMediaJson = services.media_json_stash(
+        Clients(s3_endpoint_url=services.s3_endpoint).s3(region_name=merritt_atom.MEDIA_JSON_REGION))
+    results = []
+    try:
+        pynuxrc = services.write_pynuxrc(os.path.join(workdir, 'pynuxrc'))
+        kwargs = {'pynuxrc': pynuxrc, 'dir': workdir, 'workers': argv.workers, 'stream': argv.stream}
+        if argv.fetch_concurrency:
+            kwargs['fetch_concurrency'] = argv.fetch_concurrency
+
+        # single collection
+        clients = Clients(s3_endpoint_url=services.s3_endpoint)
+        registry = RegistryClient(session=clients.session, api_base=services.registry_api, retry=clients.retry)
+        ma = MerrittAtom(SINGLE_COLLECTION_ID, merritt_id='ark:/13030/m5bench', nuxeo_path=services.collection_path(SINGLE_COLLECTION_ID),
+                         clients=clients, registry=registry, **kwargs)
+        status, elapsed = timed(ma.process_feed)
+        results.append(result('process_feed', size, elapsed, status=status, entries=ma.entry_count,
+                              feed_bytes=os.path.getsize(ma.atom_filepath), clients=clients.stats(), summary=ma.summary))
+
+        # the same feed again: media.json and the feed are already on S3
+        ma = MerrittAtom(SINGLE_COLLECTION_ID, merritt_id='ark:/13030/m5bench', nuxeo_path=services.collection_path(SINGLE_COLLECTION_ID),
+                         clients=clients, registry=registry, **kwargs)
+        status, elapsed = timed(ma.process_feed)
+        results.append(result('process_feed_rerun', size, elapsed, status=status, entries=ma.entry_count, summary=ma.summary))
+
+        root = etree.parse(ma.atom_filepath, etree.XMLParser(remove_blank_text=True, huge_tree=True)).getroot()
+        ignored, elapsed = timed(ma._write_feed, root)
+        results.append(result('write_feed', size, elapsed))
+        has_dups, elapsed = timed(ma.has_duplicates, root)
+        results.append(result('has_duplicates', size, elapsed, duplicates=has_dups))
+        del root
+
+        # refresh loop over several collections, as refresh_feeds.py runs it
+        clients = Clients(s3_endpoint_url=services.s3_endpoint)
+        registry = RegistryClient(session=clients.session, api_base=services.registry_api, retry=clients.retry)
+        feeds, elapsed = timed(registry.get_feed_info)
+        feeds = dict((collection_id, feeds[collection_id]) for collection_id in refresh_ids)
+        results.append(result('registry_feed_info', size, elapsed, collections=len(sizes)))
+
+        statuses, elapsed = timed(refresh_feeds.refresh_collections, feeds, dict(kwargs, clients=clients))
+        results.append(result('refresh_collections', collection_size * len(refresh_ids), elapsed, collections=len(refresh_ids),
+                              statuses=sorted(set(status['status'] for status in statuses.values()))))
+    finally:
+        merritt_atom.NuxeoStashMediaJson = stash_media_json
+        services.stop()
+
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark feed creation against local Nuxeo, registry and S3 stand-ins')
+    parser.add_argument("--sizes", type=int, nargs='+', default=SIZES, help="number of objects per benchmark run")
+    parser.add_argument("--components", type=int, default=3, help="number of components in each complex object")
+    parser.add_argument("--complex-every", type=int, default=3, help="make every nth object a complex object")
+    parser.add_argument("--collections", type=int, default=10, help="number of collections the refresh loop is split over")
+    parser.add_argument("--workers", type=int, default=1, help="number of threads used to build feed entries concurrently")
+    parser.add_argument("--stream", action='store_true', help="write feed entries to file as they are built")
+    parser.add_argument("--fetch-concurrency", type=int, help="number of Nuxeo requests for components to keep in flight")
+    parser.add_argument("--nuxeo-error-rate", type=float, default=0, help="share of Nuxeo requests to fail with a 503, to exercise retries")
+    parser.add_argument("--output", help="file to write JSON results to")
+    argv = parser.parse_args()
+
+    # refresh_feeds sets up INFO logging when imported
+    logging.getLogger().setLevel(logging.WARNING)
+
+    started = time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())
+    workdir = tempfile.mkdtemp(prefix='merritt_benchmark_')
+    results = []
+    try:
+        for size in argv.sizes:
+            results.extend(benchmark_size(size, argv, workdir))
+    finally:
+        shutil.rmtree(workdir)
+
+    if argv.output:
+        with open(argv.output, 'w') as f:
+            json.dump({'started': started,
+                       'python': platform.python_version(),
+                       'options': vars(argv),
+                       'results': results}, f, indent=2)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,10 +4,13 @@
 import sys
 import argparse
 from lxml import etree
-import collections
 import pprint
 pp = pprint.PrettyPrinter(indent=4)
 
+ATOM_ENTRY = "{http://www.w3.org/2005/Atom}entry"
+ATOM_LINK = "{http://www.w3.org/2005/Atom}link"
+DC_IDENTIFIER = "{http://purl.org/dc/elements/1.1/}identifier"
+
 parser = argparse.ArgumentParser(description='check for duplicates in feed')
 parser.add_argument("path", help="filepath for feed")
 argv = parser.parse_args()
@@ -15,20 +18,44 @@ argv = parser.parse_args()
 filepath = argv.path
 
 print "filepath: ", filepath
-tree = etree.parse(filepath)
-root = tree.getroot()
-feed = root.iterfind('{http://www.w3.org/2005/Atom}feed/')
-
-ids = root.iter("{http://purl.org/dc/elements/1.1/}identifier")
 
+# stream through the feed one entry at a time, so memory use doesn't grow with
+# the size of the feed. Objects are identified by the entry's dc:identifier,
+# components by their full metadata links
+parents = set()
+components = set()
+dup_parents = []
+dup_components = []
 count = 0
-idlist = []
-for identifier in ids:
+for event, entry in etree.iterparse(filepath, tag=ATOM_ENTRY, huge_tree=True):
    count = count + 1
-   #print(identifier.text), count
-   idlist.append(identifier.text)
+   uid = entry.findtext(DC_IDENTIFIER)
+   if uid in parents:
+      dup_parents.append(uid)
+   parents.add(uid)
+
+   for link in entry.iterfind(ATOM_LINK):
+      href = link.get('href', '')
+      if link.get('type') == 'application/xml' and href.endswith('.xml'):
+         component_uid = href.rsplit('/', 1)[-1][:-len('.xml')]
+         if component_uid == uid:
+            continue
+         if component_uid in components:
+            dup_components.append(component_uid)
+         components.add(component_uid)
+
+   # free the entry, and the references to it from the root
+   entry.clear()
+   while entry.getprevious() is not None:
+      del entry.getparent()[0]
+
+# components that also have an entry of their own
+dup_components.extend(components & parents)
 
-dups = [item for item, count in collections.Counter(idlist).items() if count > 1]
-pp.pprint(dups)
-print len(idlist)
-print len(dups)
+print "duplicate objects:"
+pp.pprint(dup_parents)
+print "duplicate components:"
+pp.pprint(dup_components)
+print count
+print len(dup_parents)
+print len(dup_components)
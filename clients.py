@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import threading
+import time
+import collections
+import requests
+import boto3
+from botocore.config import Config
+from requests.adapters import HTTPAdapter
+from pynux import utils
+from resilience import RetryPolicy, AdaptiveLimiter
+from os.path import expanduser
+
+""" Shared, pooled clients for Nuxeo, the registry API and S3, so that they can be reused across MerrittAtom instances and threads. """
+POOL_CONNECTIONS = 10
+POOL_MAXSIZE = 32
+DEFAULT_PYNUXRC = '~/.pynuxrc'
+# botocore retries throttled and failed S3 requests with its own backoff
+S3_MAX_ATTEMPTS = 10
+
+class Clients():
+    ''' Holds a pooled requests.Session (registry and other plain HTTP calls),
+        one thread-safe boto3 S3 client per region and a pynux Nuxeo client
+        per thread and rc file. Pass the same instance to each MerrittAtom
+        in a run to reuse connections and credentials. s3_endpoint_url points
+        S3 at somewhere other than AWS, e.g. a local stand-in. Requests to
+        Nuxeo should go through nuxeo_retry, which also adapts how many are
+        in flight to how Nuxeo is coping (listings through its call_listing);
+        other HTTP requests through retry. '''
+
+    def __init__(self, pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, s3_endpoint_url=None):
+        self.pool_maxsize = pool_maxsize
+        self.s3_endpoint_url = s3_endpoint_url
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.retry = RetryPolicy()
+        self.nuxeo_retry = RetryPolicy(limiter=AdaptiveLimiter())
+
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._s3_clients = {}
+        self._s3_calls = collections.Counter()
+        self._s3_seconds = collections.Counter()
+        self._nuxeo_clients_created = 0
+
+    def s3(self, region_name=None):
+        ''' get the shared S3 client for a region. boto3 clients are thread-safe '''
+        with self._lock:
+            if region_name not in self._s3_clients:
+                s3 = boto3.client('s3', region_name=region_name, endpoint_url=self.s3_endpoint_url,
+                                  config=Config(max_pool_connections=self.pool_maxsize,
+                                                retries={'max_attempts': S3_MAX_ATTEMPTS}))
+                s3.meta.events.register('before-call.s3', self._start_s3_call)
+                s3.meta.events.register('after-call.s3', self._count_s3_call)
+                self._s3_clients[region_name] = s3
+
+            return self._s3_clients[region_name]
+
+    def _start_s3_call(self, context, **kwargs):
+        context['started'] = time.time()
+
+    def _count_s3_call(self, model, context, **kwargs):
+        elapsed = time.time() - context['started'] if 'started' in context else 0
+        with self._lock:
+            self._s3_calls[model.name] += 1
+            self._s3_seconds[model.name] += elapsed
+
+    def s3_stats(self):
+        ''' number of calls and total seconds spent per S3 operation so far '''
+        with self._lock:
+            return dict((name, {'calls': self._s3_calls[name], 'seconds': self._s3_seconds[name]}) for name in self._s3_calls)
+
+    def nuxeo(self, pynuxrc=None):
+        ''' get the Nuxeo client for the current thread. pynux clients aren't shared across threads '''
+        rcfile = expanduser(pynuxrc if pynuxrc else DEFAULT_PYNUXRC)
+        nuxeo_clients = getattr(self._local, 'nuxeo_clients', None)
+        if nuxeo_clients is None:
+            nuxeo_clients = self._local.nuxeo_clients = {}
+
+        if rcfile not in nuxeo_clients:
+            nuxeo_clients[rcfile] = utils.Nuxeo(rcfile=open(rcfile, 'r'))
+            with self._lock:
+                self._nuxeo_clients_created += 1
+
+        return nuxeo_clients[rcfile]
+
+    def stats(self):
+        ''' connection reuse stats, for tuning pool sizes '''
+        pools = {}
+        for prefix, adapter in self.session.adapters.items():
+            for key in adapter.poolmanager.pools.keys():
+                pool = adapter.poolmanager.pools[key]
+                if pool is None:
+                    continue
+                pools['{}://{}:{}'.format(pool.scheme, pool.host, pool.port)] = {
+                    'connections': pool.num_connections,
+                    'requests': pool.num_requests}
+
+        with self._lock:
+            return {'http_pools': pools,
+                    's3_calls': dict(self._s3_calls),
+                    's3_clients': len(self._s3_clients),
+                    'http_retries': self.retry.stats(),
+                    'nuxeo_retries': self.nuxeo_retry.stats(),
+                    'nuxeo_clients': self._nuxeo_clients_created}
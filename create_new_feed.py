@@ -1,15 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import sys, os
+import sys
 import logging
-import boto3
 import argparse
-from merritt_atom import MerrittAtom
-import requests
-import json
-
-REGISTRY_BASE = 'https://registry.cdlib.org/'
+import collections
+from merritt_atom import add_feed_arguments, feed_kwargs
+from registry import RegistryClient, feed_info_from_record
+from clients import Clients
+from multiprocessing.pool import ThreadPool
+from refresh_feeds import refresh_collections, report_statuses
 
 numeric_level = getattr(logging, 'INFO', None)
 logging.basicConfig(
@@ -23,57 +23,70 @@ logger = logging.getLogger(__name__)
 def main():
 
     parser = argparse.ArgumentParser(description='refresh merritt atom feeds')
-    parser.add_argument("collectionid", help="registry ID of collection to create feed for")
-    parser.add_argument("--pynuxrc", help="rc file for use by pynux")
-    parser.add_argument("--bucket", help="S3 bucket where feed is stashed")
-    parser.add_argument("--dir", help="local directory where feed is written" )
-    parser.add_argument("--nostash", action='store_true', help="write feed to local directory and do not stash on S3")
+    parser.add_argument("collectionid", nargs='*', help="registry IDs of collections to create feeds for")
+    parser.add_argument("--ids-file", help="file of registry collection IDs to create feeds for, one per line")
+    add_feed_arguments(parser)
+    parser.add_argument("--previous-feed", help="local copy of the published feed to use for --incremental instead of fetching it from S3. Only with a single collection ID")
+    parser.add_argument("--processes", type=int, default=1, help="number of collections to create feeds for in parallel")
+    parser.add_argument("--report", help="file to write per collection status report (JSON) to")
 
     argv = parser.parse_args()
 
-    kwargs = {}
-    if argv.pynuxrc:
-        kwargs['pynuxrc'] = argv.pynuxrc
-    if argv.bucket:
-        kwargs['bucket'] = argv.bucket
-    if argv.dir:
-        kwargs['dir'] = argv.dir
-    if argv.nostash:
-        kwargs['nostash'] = argv.nostash
-
-    feeds = get_feed_info()
-
-    # create and stash new feed for each collection
-    for key, value in feeds.items():
-        if key == argv.collectionid:
-            ma = MerrittAtom(key, merritt_id=value['merritt_id'], nuxeo_path=value['nuxeo_endpoint'], **kwargs)
-            ma.process_feed()
-
-def get_feed_info():
-    ''' get list of collections for which to create feeds, based on registry info '''
-
-    feed_md = {}
-
-    url = "{}/api/v1/collection/?harvest_type=NUX&format=json".format(REGISTRY_BASE)
-
-    while True:
-        res = requests.get(url)
-        res.raise_for_status()
-        md = json.loads(res.content)
-
-        for collection in md['objects']:
-            if collection['merritt_extra_data'] and collection['merritt_id']:
-                collection_id = collection['resource_uri'].split('/')[-2]
-                feed_md[collection_id] = {'nuxeo_endpoint': collection['merritt_extra_data'], 'merritt_id': collection['merritt_id']}
-
-
-        next = md['meta']['next']
-        if not next:
-            break
-
-        url = "{}{}".format(REGISTRY_BASE, next)
- 
-    return feed_md
+    collection_ids = list(argv.collectionid)
+    if argv.ids_file:
+        with open(argv.ids_file, 'r') as f:
+            collection_ids.extend(line.strip() for line in f if line.strip() and not line.startswith('#'))
+    # drop repeats, keeping the order given
+    collection_ids = collections.OrderedDict.fromkeys(collection_ids).keys()
+    if not collection_ids:
+        parser.error("give at least one collection ID, or --ids-file")
+    if argv.previous_feed and len(collection_ids) > 1:
+        parser.error("--previous-feed is a copy of one collection's feed; give only that collection's ID")
+
+    kwargs = feed_kwargs(argv)
+    if argv.previous_feed:
+        kwargs['previous_feed'] = argv.previous_feed
+
+    clients = Clients()
+    registry = RegistryClient(cache_dir=argv.registry_cache, session=clients.session, retry=clients.retry)
+    feeds, statuses = lookup_collections(registry, collection_ids)
+
+    # create and stash new feed for each collection, sharing clients
+    statuses.update(refresh_collections(feeds, dict(kwargs, clients=clients), processes=argv.processes))
+    report_statuses(statuses, argv.report)
+
+    if any(status['status'] != 'OK' for status in statuses.values()):
+        return 1
+
+def lookup_collections(registry, collection_ids):
+    ''' look up each collection directly in the registry. Returns a dict of
+        collection id -> registry info for those that get a feed, and a dict
+        of collection id -> status dict for those that can't '''
+    def lookup(collection_id):
+        try:
+            return collection_id, feed_info_from_record(registry.get_collection(collection_id, save=False)), None
+        except Exception as e:
+            return collection_id, None, '{}: {}'.format(type(e).__name__, e)
+
+    pool = ThreadPool(registry.threads)
+    try:
+        results = pool.map(lookup, collection_ids)
+    finally:
+        pool.terminate()
+    registry.save_cache()
+
+    feeds = {}
+    statuses = {}
+    for collection_id, value, error in results:
+        if value:
+            feeds[collection_id] = value
+            continue
+        if not error:
+            error = "No Merritt ID or Nuxeo path in the registry"
+        logger.error("Collection {}: {}".format(collection_id, error))
+        statuses[collection_id] = {'collection_id': collection_id, 'status': 'ERROR', 'entries': None, 'error': error, 'duration': None, 'summary': None}
+
+    return feeds, statuses
 
 if __name__ == "__main__":
     sys.exit(main())
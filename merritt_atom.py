@@ -3,8 +3,7 @@
 
 import sys, os
 from lxml import etree
-from pynux import utils
-from datetime import datetime
+from datetime import datetime, timedelta
 import dateutil.tz
 from dateutil.parser import parse
 import urlparse
@@ -12,26 +11,297 @@ from deepharvest.deepharvest_nuxeo import DeepHarvestNuxeo
 from os.path import expanduser
 import codecs
 import json
-import requests
-import boto3
+from botocore.exceptions import ClientError
 import logging
 from operator import itemgetter
 import collections
+import gzip
+import hashlib
+import shutil
+from io import BytesIO
+from xml.sax.saxutils import unescape
+import threading
+import time
+from contextlib import contextmanager
+from multiprocessing.pool import ThreadPool
 from s3stash.nxstash_mediajson import NuxeoStashMediaJson
+from registry import RegistryClient
+from clients import Clients
+from nuxeo_fetch import NuxeoFetcher
+from metadata_store import MetadataStore
 
 """ Given the Nuxeo document path for a collection folder, publish ATOM feed for objects for Merritt harvesting. """
 ATOM_NS = "http://www.w3.org/2005/Atom"
 DC_NS = "http://purl.org/dc/elements/1.1/"
 NX_NS = "http://www.nuxeo.org/ecm/project/schemas/tingle-california-digita/ucldc_schema"
 OPENSEARCH_NS = "http://a9.com/-/spec/opensearch/1.1/"
+FH_NS = "http://purl.org/syndication/history/1.0"
 NS_MAP = {None: ATOM_NS,
           "nx": NX_NS,
           "dc": DC_NS,
           "opensearch": OPENSEARCH_NS}
-REGISTRY_API_BASE = 'https://registry.cdlib.org/api/v1/'
 BUCKET = 'static.ucldc.cdlib.org/merritt'
 MEDIA_JSON_BUCKET = 'static.ucldc.cdlib.org/merritt_media_json'
 MEDIA_JSON_REGION = 'us-east-1'
+METADATA_CACHE_SIZE = 5000
+# start a new generation of archive pages once this share of archived entries is out of date
+PAGE_STALE_RATIO = 0.25
+# properties that must be present for a doc to stand in for a full get_metadata() response
+FULL_MD_PROPERTIES = ('file:content', 'files:files', 'extra_files:file')
+# bump when entries are built differently, so stored ones aren't reused
+ENTRY_FORMAT = 2
+# the types deepharvest's fetch_components returns as components. as there,
+# they're taken from anywhere under the object, including inside folders
+COMPONENT_TYPES = ('SampleCustomPicture', 'CustomFile', 'CustomVideo', 'CustomAudio', 'CustomThreeD')
+COMPONENT_NXQL = "SELECT * FROM " + ", ".join(COMPONENT_TYPES) + " WHERE ecm:path STARTSWITH '{}' AND " \
+                 "ecm:isTrashed = 0 ORDER BY ecm:pos"
+# trashed documents are included, so that a component being trashed counts as a change.
+# results are paged, so they're in a stable order; a document modified during the
+# scan can only be added to the results, which repeats one but doesn't skip any
+MODIFIED_SINCE_NXQL = "SELECT * FROM Document WHERE ecm:path STARTSWITH '{}' AND dc:modified >= TIMESTAMP '{}' " \
+                      "ORDER BY ecm:uuid"
+# all that's needed from that search is each document's path and dc:modified
+MODIFIED_SINCE_PROPERTIES = 'dublincore'
+# look for component changes this many seconds before an earlier scan, in case the Nuxeo clock is behind ours
+SCAN_MARGIN = 600
+INDEX_VERSION = 1
+# entries are direct children of the pretty-printed feed element
+ENTRY_START = b'  <entry>\n'
+ENTRY_END = b'  </entry>\n'
+
+# an entry copied as is from the published feed, with the uids of the components it lists
+RawEntry = collections.namedtuple('RawEntry', ['fragment', 'components'])
+
+class DocRecord(object):
+    ''' the parts of a parent level Nuxeo doc needed to build its entry. The
+        full document JSON, with all of its descriptive metadata, can be
+        several KB; a collection's worth is held for the whole run, so docs
+        are projected to these as soon as they're fetched. Only the file
+        properties are kept of the doc's properties, so a record can stand
+        in for the full metadata when building links.
+        Supports doc['key'] access like the original dict. '''
+    __slots__ = ('uid', 'path', 'title', 'lastModified', 'bundle_lastModified',
+                 'creators', 'date', 'identifier', 'collection', 'properties')
+
+    def __init__(self, doc):
+        properties = doc['properties']
+        self.uid = doc['uid']
+        self.path = doc['path']
+        self.title = doc['title']
+        self.lastModified = doc['lastModified']
+        self.bundle_lastModified = doc.get('bundle_lastModified')
+        self.creators = tuple(creator['name'] for creator in properties['ucldc_schema:creator'])
+        dates = properties['ucldc_schema:date']
+        self.date = dates[0]['date'] if dates else None
+        self.identifier = properties['ucldc_schema:identifier']
+        collections = properties['ucldc_schema:collection']
+        self.collection = collections[0] if collections else None
+        self.properties = dict((prop, properties[prop]) for prop in FULL_MD_PROPERTIES if prop in properties)
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+class MetadataCache():
+    ''' bounded LRU cache of full Nuxeo document metadata, keyed by uid '''
+
+    def __init__(self, maxsize=METADATA_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._docs = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, uid):
+        ''' return cached metadata for uid, or None '''
+        with self._lock:
+            try:
+                doc = self._docs.pop(uid)
+            except KeyError:
+                self.misses = self.misses + 1
+                return None
+
+            # re-insert to mark as most recently used
+            self._docs[uid] = doc
+            self.hits = self.hits + 1
+            return doc
+
+    def put(self, uid, doc):
+        ''' add metadata for uid, evicting the least recently used doc if full '''
+        with self._lock:
+            self._docs.pop(uid, None)
+            self._docs[uid] = doc
+            while len(self._docs) > self.maxsize:
+                self._docs.popitem(last=False)
+                self.evictions = self.evictions + 1
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._docs),
+                    'maxsize': self.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+class EntryIds():
+    ''' Nuxeo ids of the objects and components written to a feed so far, so
+        that repeats are caught as entries are built. An object repeated as an
+        entry makes the feed a duplicate; a component listed more than once
+        (in two entries, or also as an object) is only reported. '''
+
+    def __init__(self):
+        self.parents = set()
+        self.components = {}
+        self.duplicate_parents = []
+        self.duplicate_components = []
+
+    def add_parent(self, uid):
+        ''' record the object for an entry. Returns False if it already has one '''
+        if uid in self.components:
+            self.duplicate_components.append(uid)
+
+        if uid in self.parents:
+            self.duplicate_parents.append(uid)
+            return False
+
+        self.parents.add(uid)
+        return True
+
+    def add_components(self, parent_uid, component_uids):
+        ''' record the components listed in an object's entry. Returns those already seen '''
+        repeats = []
+        for uid in component_uids:
+            if uid in self.components or uid in self.parents:
+                repeats.append(uid)
+            else:
+                self.components[uid] = parent_uid
+
+        self.duplicate_components.extend(repeats)
+        return repeats
+
+    def stats(self):
+        return {'entries': len(self.parents),
+                'components': len(self.components),
+                'duplicate_parents': len(self.duplicate_parents),
+                'duplicate_components': len(self.duplicate_components)}
+
+class FeedStats():
+    ''' wall time per phase and counters for one feed run. Phases that run on
+        several threads at once (building entries, checking ids) add up the
+        time spent on each thread, so can exceed the wall time of the run '''
+
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self.counters = collections.Counter()
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def phase(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.time() - started)
+
+    def add_time(self, name, seconds):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0) + seconds
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def summary(self):
+        with self._lock:
+            return {'seconds': collections.OrderedDict((name, round(seconds, 3)) for name, seconds in self.phases.items()),
+                    'counters': dict(self.counters)}
+
+class Checkpoint():
+    ''' journal of the entries built and media.json stashed during a feed run,
+        one JSON line each, so that a run that fails part way can be resumed
+        without redoing that work. Anything recorded for an object is only
+        used if the object hasn't been modified since. '''
+
+    def __init__(self, filepath):
+        self.filepath = filepath
+        self.entries = {}
+        self.media_json = {}
+        self.resumed = set()
+        # when the earliest run journaled here started looking for modified components
+        self.scanned = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def load(self):
+        ''' read the journal from an earlier run, if there is one '''
+        try:
+            with open(self.filepath, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # last line of a run that died mid-write
+                        continue
+                    if 'scanned' in record:
+                        scanned = parse(record['scanned'])
+                        if self.scanned is None or scanned < self.scanned:
+                            self.scanned = scanned
+                    elif 'entry' in record:
+                        self.entries[record['uid']] = (record['updated'], record['entry'].encode('utf-8'))
+                    else:
+                        self.media_json[record['uid']] = record['updated']
+        except IOError:
+            pass
+
+    def open(self):
+        self._file = open(self.filepath, 'a')
+
+    def _write(self, record):
+        line = json.dumps(record) + '\n'
+        with self._lock:
+            self._file.write(line)
+            self._file.flush()
+
+    def take_entry(self, uid, updated):
+        ''' serialized entry for an object, if journaled as of updated, else None '''
+        if uid not in self.entries:
+            return None
+        journaled, fragment = self.entries.pop(uid)
+        if journaled != updated:
+            return None
+        self.resumed.add(uid)
+        return fragment
+
+    def add_scanned(self, scanned):
+        self._write({'scanned': scanned.isoformat()})
+
+    def add_entry(self, uid, updated, fragment):
+        self._write({'uid': uid, 'updated': updated, 'entry': fragment.decode('utf-8')})
+
+    def has_media_json(self, uid, updated):
+        return self.media_json.get(uid) == updated
+
+    def add_media_json(self, uid, updated):
+        self._write({'uid': uid, 'updated': updated})
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        self.close()
+        if os.path.exists(self.filepath):
+            os.remove(self.filepath)
 
 class MerrittAtom():
 
@@ -61,6 +331,115 @@ class MerrittAtom():
         else:
             self.nostash = False
 
+        if 'workers' in kwargs:
+            self.workers = kwargs['workers']
+        else:
+            self.workers = 1
+
+        if 'stream' in kwargs:
+            self.stream = kwargs['stream']
+        else:
+            self.stream = False
+
+        if 'incremental' in kwargs:
+            self.incremental = kwargs['incremental']
+        else:
+            self.incremental = False
+
+        if 'previous_feed' in kwargs:
+            self.previous_feed = kwargs['previous_feed']
+        else:
+            self.previous_feed = None
+
+        # fetch components this many at a time over plain HTTP, ahead of building entries
+        if 'fetch_concurrency' in kwargs:
+            self.fetch_concurrency = kwargs['fetch_concurrency']
+        else:
+            self.fetch_concurrency = None
+
+        # cap on connections to Nuxeo for the above; defaults to fetch_concurrency
+        if 'fetch_connections' in kwargs:
+            self.fetch_connections = kwargs['fetch_connections']
+        else:
+            self.fetch_connections = None
+        self.fetcher = None
+
+        # journal progress to a checkpoint file in dir, and pick up from it if a run failed
+        if 'resume' in kwargs:
+            self.resume = kwargs['resume']
+        else:
+            self.resume = False
+        self.checkpoint = None
+
+        # keep component metadata and built entries in a store in this directory between runs
+        if 'metadata_store' in kwargs:
+            self.metadata_store = kwargs['metadata_store']
+        else:
+            self.metadata_store = None
+        self.store = None
+
+        # entries from the published feed, by nuxeo uid. populated for incremental runs
+        self.previous_entries = {}
+        self.reused_entries = 0
+        self._parsed_dates = {}
+
+        # media.json stash errors from the last run, by nuxeo uid
+        self.media_json_failures = {}
+        self._stash_pool = None
+        self._stash_results = None
+
+        # number of entries in the feed from the last run
+        self.entry_count = None
+
+        self._collection_metadata = None
+
+        # component uids of each entry written, for the feed index
+        self._index_components = {}
+        # local copy of the published feed, to copy reused entries from
+        self._previous_feed_file = None
+        # when this run started looking for modified components, and when the
+        # run that made the published feed did, if its index says
+        self.scanned = None
+        self._previous_scanned = None
+
+        if 'gzip' in kwargs:
+            self.gzip = kwargs['gzip']
+        else:
+            self.gzip = False
+
+        if 'page_size' in kwargs:
+            self.page_size = kwargs['page_size']
+        else:
+            self.page_size = None
+
+        # drop repeated entries rather than refusing to stash the feed
+        if 'dedup' in kwargs:
+            self.dedup = kwargs['dedup']
+        else:
+            self.dedup = False
+        self.entry_ids = EntryIds()
+
+        self.stats = FeedStats()
+        # JSON-able summary of the last process_feed run
+        self.summary = None
+
+        if 'cache_size' in kwargs:
+            self.md_cache = MetadataCache(kwargs['cache_size'])
+        else:
+            self.md_cache = MetadataCache()
+
+        if 'clients' in kwargs:
+            self.clients = kwargs['clients']
+        else:
+            self.clients = Clients()
+
+        if 'registry' in kwargs:
+            self.registry = kwargs['registry']
+        elif 'registry_cache' in kwargs:
+            self.registry = RegistryClient(cache_dir=kwargs['registry_cache'], session=self.clients.session, retry=self.clients.retry)
+        else:
+            self.registry = RegistryClient(session=self.clients.session, retry=self.clients.retry)
+
         self.logger.info("collection_id: {}".format(self.collection_id))
 
         if 'nuxeo_path' in kwargs:
@@ -78,11 +457,12 @@ class MerrittAtom():
 
         self.feed_base_url = 'https://s3.amazonaws.com/{}/'.format(self.bucket)
 
+        self.pynuxrc = pynuxrc
         if pynuxrc:
-            self.nx = utils.Nuxeo(rcfile=open(expanduser(pynuxrc),'r'))
+            self.nx = self.clients.nuxeo(pynuxrc)
             self.dh = DeepHarvestNuxeo(self.path, '', pynuxrc=pynuxrc)
         elif not(pynuxrc) and os.path.isfile(expanduser('~/.pynuxrc')):
-            self.nx = utils.Nuxeo(rcfile=open(expanduser('~/.pynuxrc'),'r'))
+            self.nx = self.clients.nuxeo()
             self.dh = DeepHarvestNuxeo(self.path, '')
 
         self.atom_file = self._get_filename(self.collection_id)
@@ -95,20 +475,14 @@ class MerrittAtom():
 
     def _get_merritt_id(self):
         ''' given collection registry ID, get corresponding Merritt collection ID '''
-        url = "{}collection/{}/?format=json".format(REGISTRY_API_BASE, self.collection_id)
-        res = requests.get(url)
-        res.raise_for_status()
-        md = json.loads(res.text)
+        md = self.registry.get_collection(self.collection_id)
         merritt_id = md['merritt_id']
 
         return merritt_id 
 
     def _get_nuxeo_path(self):
         ''' given ucldc registry collection ID, get Nuxeo path for collection '''
-        url = "{}collection/{}/?format=json".format(REGISTRY_API_BASE, self.collection_id)
-        res = requests.get(url)
-        res.raise_for_status()
-        md = json.loads(res.text)
+        md = self.registry.get_collection(self.collection_id)
         nuxeo_path = md['harvest_extra_data']
 
         return nuxeo_path 
@@ -121,28 +495,28 @@ class MerrittAtom():
 
     def _extract_nx_metadata(self, raw_metadata): 
         ''' extract Nuxeo metadata we want to post to the ATOM feed '''
+        if not isinstance(raw_metadata, DocRecord):
+            raw_metadata = DocRecord(raw_metadata)
+
         metadata = {}
         
         # last modified 
-        metadata['lastModified'] = raw_metadata['bundle_lastModified']
+        metadata['lastModified'] = raw_metadata.bundle_lastModified
 
         # creator
-        creators = raw_metadata['properties']['ucldc_schema:creator']
-        metadata['creator'] = [creator['name'] for creator in creators]
+        metadata['creator'] = list(raw_metadata.creators)
 
         # title
-        metadata['title'] = raw_metadata['title']
+        metadata['title'] = raw_metadata.title
 
         # date
-        dates = raw_metadata['properties']['ucldc_schema:date']
-        dates = [date['date'] for date in dates]
-        metadata['date'] = dates[0] if dates else None
+        metadata['date'] = raw_metadata.date
 
         # nuxeo id
-        metadata['id'] = raw_metadata['properties']['ucldc_schema:identifier']
+        metadata['id'] = raw_metadata.identifier
 
         # nuxeo collection
-        metadata['collection'] = raw_metadata['properties']['ucldc_schema:collection'][0] if raw_metadata['properties']['ucldc_schema:collection'] else None
+        metadata['collection'] = raw_metadata.collection
 
         return metadata
 
@@ -150,73 +524,92 @@ class MerrittAtom():
         ''' construct ATOM feed entry element for a given nuxeo doc, including files for any component objects '''
         uid = doc['uid']
 
-        # parent
+        # parent. fetch_objects already gave us its full metadata
+        self._seed_metadata_cache([doc])
         nx_metadata = self._extract_nx_metadata(doc)
         entry = etree.Element(etree.QName(ATOM_NS, "entry"))
         entry = self._populate_entry(entry, nx_metadata, uid, True)
 
         # insert component md
-        for c in self.dh.fetch_components(doc):
+        components = self._fetch_components(doc)
+        for c in components:
             self._insert_full_md_link(entry, c['uid'])
-            self._insert_main_content_link(entry, c['uid'])
-            self._insert_aux_links(entry, c['uid'])
+            self._insert_main_content_link(entry, c['uid'], c)
+            self._insert_aux_links(entry, c['uid'], c)
+
+        if self.store:
+            self.store.put(uid, doc['bundle_lastModified'].isoformat(),
+                           [self._component_record(c) for c in components],
+                           self._serialize_entry(entry))
 
         return entry
 
     def _add_atom_elements(self, doc):
         ''' add atom feed elements to document '''
 
-        # recommended ATOM feed elements
-        feed_author = etree.Element(etree.QName(ATOM_NS, "author"))
-        feed_author.text = "UC Libraries Digital Collection"
-        doc.insert(0, feed_author)
-
         # required ATOM feed elements
-        feed_title = etree.Element(etree.QName(ATOM_NS, "title"))
+        feed_id = etree.SubElement(doc, etree.QName(ATOM_NS, "id"))
+        feed_id.text = self.s3_url 
+
+        feed_title = etree.SubElement(doc, etree.QName(ATOM_NS, "title"))
         feed_title.text = "UCLDC Metadata Feed" # FIXME get campus name from registry API?
-        doc.insert(0, feed_title)
 
-        feed_id = etree.Element(etree.QName(ATOM_NS, "id"))
-        feed_id.text = self.s3_url 
-        doc.insert(0, feed_id)
+        # recommended ATOM feed elements
+        feed_author = etree.SubElement(doc, etree.QName(ATOM_NS, "author"))
+        feed_author.text = "UC Libraries Digital Collection"
 
         return doc 
 
     def _add_feed_updated(self, doc, updated):
         ''' add feed updated '''
-        feed_updated = etree.Element(etree.QName(ATOM_NS, "updated"))
+        feed_updated = etree.SubElement(doc, etree.QName(ATOM_NS, "updated"))
         feed_updated.text = updated 
-        doc.insert(0, feed_updated)
+
+    def _feed_updated_now(self):
+        ''' feed updated for the current time. Always has microseconds, so
+            every stamp is the same width and can be rewritten in place '''
+        return datetime.now(dateutil.tz.tzutc()).strftime('%Y-%m-%dT%H:%M:%S.%f+00:00')
 
     def _add_collection_alt_link(self, doc, path):
         ''' add elements related to Nuxeo collection info to document '''
-        collection_metadata = self.nx.get_metadata(path=path)
+        if self._collection_metadata is None:
+            self.stats.count('nuxeo_get_metadata')
+            self._collection_metadata = self.clients.nuxeo_retry.call(self.nx.get_metadata, path=path)
+        collection_metadata = self._collection_metadata
         collection_title = collection_metadata['title']
         collection_uid = collection_metadata['uid']
         collection_uri = self.get_object_view_url(collection_uid)
 
-        feed_link_alt = etree.Element(etree.QName(ATOM_NS, "link"), rel="alternate", href=collection_uri, title=collection_title) 
-        doc.insert(0, feed_link_alt)
+        feed_link_alt = etree.SubElement(doc, etree.QName(ATOM_NS, "link"), rel="alternate", href=collection_uri, title=collection_title) 
 
         return doc
 
-    def _add_paging_info(self, doc):
-        ''' add rel links for paging '''
-        # this is just dumb for now
-        last_link = etree.Element(etree.QName(ATOM_NS, "link"), rel="last", href=self.s3_url)
-        doc.insert(0, last_link)
+    def _add_paging_info(self, doc, links=None, archive=False):
+        ''' add rel links for paging. links is a list of (rel, href) for paged
+            feeds; a single file feed is its own first and last page '''
+        if links is None:
+            links = [('self', self.s3_url), ('first', self.s3_url), ('last', self.s3_url)]
 
-        first_link = etree.Element(etree.QName(ATOM_NS, "link"), rel="first", href=self.s3_url)
-        doc.insert(0, first_link)
+        for rel, href in links:
+            etree.SubElement(doc, etree.QName(ATOM_NS, "link"), rel=rel, href=href)
 
-        self_link = etree.Element(etree.QName(ATOM_NS, "link"), rel="self", href=self.s3_url)
-        doc.insert(0, self_link)
+        # RFC 5005 archive document
+        if archive:
+            etree.SubElement(doc, etree.QName(FH_NS, "archive"))
+
+    def _add_header(self, doc, links=None, archive=False):
+        ''' append header info to feed document. Elements are appended in
+            document order, so this must be called before any entries are added '''
+        self._add_feed_updated(doc, self._feed_updated_now())
+        self._add_atom_elements(doc)
+        self._add_collection_alt_link(doc, self.path)
+        self._add_paging_info(doc, links, archive)
+        self._add_merritt_id(doc, self.merritt_id)
 
     def _add_merritt_id(self, doc, merritt_collection_id):
         ''' add Merritt ID '''
-        merritt_id = etree.Element(etree.QName(ATOM_NS, "merritt_collection_id"))
-        merritt_id.text = merritt_collection_id 
-        doc.insert(0, merritt_id)
+        merritt_id = etree.SubElement(doc, etree.QName(ATOM_NS, "merritt_collection_id"))
+        merritt_id.text = merritt_collection_id
 
     def _populate_entry(self, entry, metadata, nxid, is_parent):
         ''' get <entry> element for a given set of object metadata '''
@@ -284,8 +677,67 @@ class MerrittAtom():
         link_media_json = etree.SubElement(entry, etree.QName(ATOM_NS, "link"), rel="alternate", href=media_json_url, type="application/json", title="Deep Harvest metadata for this object") 
 
 
-    def _insert_main_content_link(self, entry, uid):
-        nx_metadata = self.nx.get_metadata(uid=uid)
+    def _get_nx(self):
+        ''' get the Nuxeo client for the current thread, so workers don't share a session '''
+        return self.clients.nuxeo(self.pynuxrc)
+
+    def _get_metadata(self, uid):
+        ''' get full Nuxeo metadata for an object, going through the per-run cache '''
+        nx_metadata = self.md_cache.get(uid)
+        if nx_metadata is None:
+            self.stats.count('nuxeo_get_metadata')
+            nx_metadata = self.clients.nuxeo_retry.call(self._get_nx().get_metadata, uid=uid)
+            self.md_cache.put(uid, nx_metadata)
+
+        return nx_metadata
+
+    def _is_full_metadata(self, doc):
+        ''' check whether a doc includes the file properties we'd otherwise get from get_metadata '''
+        properties = doc.get('properties') or {}
+        return all(prop in properties for prop in FULL_MD_PROPERTIES)
+
+    def _seed_metadata_cache(self, docs):
+        ''' add docs we already have in hand to the metadata cache, so we don't fetch them again '''
+        for doc in docs:
+            if self._is_full_metadata(doc):
+                self.md_cache.put(doc['uid'], doc)
+
+    def _component_record(self, c):
+        ''' the parts of a component's metadata used to build entries, as kept in the metadata store '''
+        return {'uid': c['uid'],
+                'title': c['title'],
+                'properties': dict((prop, c['properties'][prop]) for prop in FULL_MD_PROPERTIES)}
+
+    def _component_query(self, doc):
+        ''' NXQL for the components of an object '''
+        return COMPONENT_NXQL.format(doc['path'].replace("'", "\\'"))
+
+    def _fetch_components(self, doc):
+        ''' fetch full metadata for all components of an object via paged NXQL,
+            rather than one get_metadata request per component. Comes from the
+            metadata store instead if the object hasn't changed since it was stored '''
+        if self.store:
+            components = self.store.get_components(doc['uid'], doc['bundle_lastModified'].isoformat())
+            if components is not None:
+                self.stats.count('store_component_hits')
+                return components
+
+        components = []
+        results = self.fetcher.results(doc['uid']) if self.fetcher else None
+        if results is None:
+            self.stats.count('nuxeo_queries')
+            results = self.clients.nuxeo_retry.call_listing(lambda: list(self._get_nx().nxql(self._component_query(doc))))
+        for c in results:
+            if not self._is_full_metadata(c):
+                # pynux conf doesn't return file schemas in search results
+                c = self._get_metadata(c['uid'])
+            components.append(c)
+
+        return components
+
+    def _insert_main_content_link(self, entry, uid, nx_metadata=None):
+        if nx_metadata is None:
+            nx_metadata = self._get_metadata(uid)
         nuxeo_file_download_url = self.get_object_download_url(nx_metadata)
         checksum = self.get_nuxeo_file_checksum(nx_metadata)
         if nuxeo_file_download_url:
@@ -295,8 +747,9 @@ class MerrittAtom():
             checksum_element = etree.SubElement(main_content_link, etree.QName(OPENSEARCH_NS, "checksum"), algorithm="MD5")
             checksum_element.text = checksum
 
-    def _insert_aux_links(self, entry, uid):
-        nx_metadata = self.nx.get_metadata(uid=uid)
+    def _insert_aux_links(self, entry, uid, nx_metadata=None):
+        if nx_metadata is None:
+            nx_metadata = self._get_metadata(uid)
         aux_files = self.get_aux_files(nx_metadata)
         for af in aux_files:
             link_aux_file = etree.SubElement(entry, etree.QName(ATOM_NS, "link"), rel="alternate", href=af['url'], title="Auxiliary file")
@@ -309,40 +762,526 @@ class MerrittAtom():
         link_md = etree.SubElement(entry, etree.QName(ATOM_NS, "link"), rel="alternate", href=full_metadata_url, type="application/xml", title="Full metadata for this object from Nuxeo")
 
 
+    def _build_feed(self, docs):
+        ''' build the feed document in memory. docs are sorted oldest first;
+            entries are appended newest first, after the header '''
+        # create root
+        root = etree.Element(etree.QName(ATOM_NS, "feed"), nsmap=NS_MAP)
+
+        # add header info
+        logging.info("Adding header info to xml tree")
+        self._add_header(root)
+
+        # add entries
+        for document, entry in self._iter_entries(reversed(docs)):
+            nxid = document['uid']
+            self.logger.info("inserting entry for object {} {}".format(nxid, document['path']))
+            root.append(self._entry_element(entry))
+
+        # the feed is updated as of when its entries are done
+        root.find(etree.QName(ATOM_NS, "updated").text).text = self._feed_updated_now()
+
+        return root
+
     def _write_feed(self, doc):
         ''' publish feed '''
-        feed = etree.ElementTree(doc)
-        feed_string = etree.tostring(feed, pretty_print=True, encoding='utf-8', xml_declaration=True)
+        with self.stats.phase('serialize'):
+            feed = etree.ElementTree(doc)
+            feed_string = etree.tostring(feed, pretty_print=True, encoding='utf-8', xml_declaration=True)
+
+            with open(self.atom_filepath, "w") as f:
+                f.write(feed_string)
+
+    def _serialize_entry(self, entry):
+        ''' serialize a single <entry> exactly as it would appear inside the pretty-printed feed '''
+        if isinstance(entry, RawEntry):
+            return entry.fragment
+
+        # serializing an element on its own (or via etree.xmlfile) redeclares
+        # the namespaces on every entry, so serialize it inside an empty feed
+        # element and slice out the child
+        wrapper = etree.Element(etree.QName(ATOM_NS, "feed"), nsmap=NS_MAP)
+        wrapper.append(entry)
+        wrapper_string = etree.tostring(wrapper, pretty_print=True, encoding='utf-8')
+        start = wrapper_string.index(b'>\n') + 2
+        end = wrapper_string.rindex(b'</feed>')
+
+        return wrapper_string[start:end]
+
+    def _parse_entry(self, fragment):
+        ''' parse an entry serialized by _serialize_entry back into an element '''
+        # the fragment relies on namespaces declared on the feed element
+        wrapper_string = etree.tostring(etree.Element(etree.QName(ATOM_NS, "feed"), nsmap=NS_MAP))
+        opening = wrapper_string[:-len(b'/>')] + b'>'
+        wrapper = etree.fromstring(opening + fragment + b'</feed>', etree.XMLParser(remove_blank_text=True))
+
+        return wrapper[0]
+
+    def _entry_element(self, entry):
+        ''' the element for an entry, parsing it if it was copied from the published feed '''
+        if isinstance(entry, RawEntry):
+            return self._parse_entry(entry.fragment)
+        return entry
 
-        with open(self.atom_filepath, "w") as f:
-            f.write(feed_string)
-      
-    def _s3_get_feed(self):
-       """ Retrieve ATOM feed file from S3. Return as ElementTree object """
-       bucketpath = self.bucket.strip("/")
-       bucketbase = self.bucket.split("/")[0]
+    def _get_index_filename(self):
+        return 'ucldc_collection_{}.index.jsonl'.format(self.collection_id)
+
+    def _entry_line_text(self, lines, start_tag):
+        ''' text of the element on the line of a serialized entry that starts with start_tag '''
+        for line in lines:
+            if line.startswith(start_tag):
+                return unescape(line[len(start_tag):line.rindex(b'</')].decode('utf-8'))
+        return None
+
+    def _scan_feed_entries(self, filepath, components=None):
+        ''' yield an index record for each entry of a feed file, with its
+            dc:identifier, atom:updated, component uids, sha256 and byte range
+            in the file. The file is scanned line by line, as written by
+            _write_feed or _write_feed_streaming. components are the component
+            uids by object uid; if not given, each entry is parsed for them '''
+        offset = 0
+        start = None
+        with open(filepath, 'rb') as f:
+            for line in f:
+                if line == ENTRY_START:
+                    start = offset
+                    lines = []
+                offset = offset + len(line)
+                if start is None:
+                    continue
+                lines.append(line)
+                if line == ENTRY_END:
+                    fragment = b''.join(lines)
+                    uid = self._entry_line_text(lines, b'    <dc:identifier>')
+                    if components is None:
+                        component_ids = self._entry_component_ids(uid, self._parse_entry(fragment))
+                    else:
+                        component_ids = components.get(uid, [])
+                    yield {'id': uid,
+                           'updated': self._entry_line_text(lines, b'    <updated>'),
+                           'components': component_ids,
+                           'sha256': hashlib.sha256(fragment).hexdigest(),
+                           'offset': start,
+                           'length': len(fragment)}
+                    start = None
+
+    def _write_feed_index(self):
+        ''' write a sidecar index for the feed file, in JSON lines: a header with
+            the feed digest, then a line per entry as from _scan_feed_entries.
+            Returns the index filename '''
+        records = list(self._scan_feed_entries(self.atom_filepath, self._index_components))
+
+        filename = self._get_index_filename()
+        with open(os.path.join(self.dir, filename), 'w') as f:
+            f.write(json.dumps({'version': INDEX_VERSION, 'feed': self.atom_file, 'entries': len(records),
+                                'digest': self._feed_digest(self.atom_filepath),
+                                'scanned': self.scanned.isoformat() if self.scanned else None}, sort_keys=True) + '\n')
+            for record in records:
+                f.write(json.dumps(record, sort_keys=True) + '\n')
+
+        return filename
+
+    def _get_checkpoint_filename(self):
+        return 'ucldc_collection_{}.checkpoint'.format(self.collection_id)
+
+    def _remove_checkpoint(self):
+        ''' the run is finished, so a retry can start over '''
+        if self.checkpoint:
+            self.checkpoint.remove()
+            self.checkpoint = None
+
+    def _write_feed_streaming(self, docs, filepath=None, links=None, archive=False):
+        ''' write the feed to file incrementally: header first, then each entry
+            as soon as it's built. Only one entry is held in memory at a time.
+            filepath, links and archive are for the pages of a paged feed.
+            Returns True if there were duplicate entries. '''
+        if filepath is None:
+            filepath = self.atom_filepath
+
+        nsmap = dict(NS_MAP, fh=FH_NS) if links else NS_MAP
+        header = etree.Element(etree.QName(ATOM_NS, "feed"), nsmap=nsmap)
+        self._add_header(header, links, archive)
+        header_string = etree.tostring(etree.ElementTree(header), pretty_print=True, encoding='utf-8', xml_declaration=True)
+        close = header_string.rindex(b'</feed>')
+        stamp = header_string.index(b'<updated>') + len(b'<updated>')
+
+        with open(filepath, "wb") as f:
+            f.write(header_string[:close])
+
+            # newest first, same as the in-memory feed
+            for document, entry in self._iter_entries(reversed(docs)):
+                self.logger.info("writing entry for object {} {}".format(document['uid'], document['path']))
+                with self.stats.phase('serialize'):
+                    f.write(self._serialize_entry(entry))
+
+            f.write(header_string[close:])
+
+            # the feed is updated as of when its entries are done; the
+            # stamp is fixed width, so overwrite the one in the header
+            f.seek(stamp)
+            f.write(self._feed_updated_now().encode('utf-8'))
+
+        return self._has_duplicate_entries()
+
+    def _get_page_filename(self, generation, number):
+        ''' filename for an archive page of a paged feed '''
+        return 'ucldc_collection_{}_{}_{}.atom'.format(self.collection_id, generation, number)
+
+    def _get_page_manifest_filename(self):
+        ''' filename for the list of archive pages of a paged feed '''
+        return 'ucldc_collection_{}.pages.json'.format(self.collection_id)
+
+    def _load_page_manifest(self):
+        ''' get the archive page manifest from the last run, from s3 or, if not stashing, the local dir '''
+        filename = self._get_page_manifest_filename()
+        try:
+            if self.nostash:
+                with open(os.path.join(self.dir, filename), 'r') as f:
+                    return json.load(f)
+            bucketbase, keypath = self._s3_location(self.bucket, filename)
+            return json.loads(self._s3_get_contents(self.clients.s3().get_object(Bucket=bucketbase, Key=keypath)))
+        except (IOError, ValueError, ClientError) as e:
+            self.logger.info("No page manifest for paged feed; writing all pages: {}".format(e))
+            return None
+
+    def _write_paged_feed(self, docs):
+        ''' write the feed as RFC 5005 pages of up to page_size entries: a head
+            page at the usual feed url with the newest entries, and archive
+            pages of older entries. Archive pages from earlier runs are kept
+            as they are while their entries are up to date. An object that
+            changes or goes away is dropped from its archive page, which is
+            rewritten, and a changed object moves to the head, so no object
+            appears on more than one page. Once too much of the archive has
+            been dropped, a new generation of pages is written.
+            Returns (has_dups, filenames of archive pages and manifest to
+            upload, filenames of archive pages from an old generation to remove) '''
+        current = dict((doc['uid'], doc['bundle_lastModified'].isoformat()) for doc in docs)
+        docs_by_uid = dict((doc['uid'], doc) for doc in docs)
+
+        manifest = self._load_page_manifest()
+        obsolete = []
+        rewrite = set()
+        if manifest and manifest['page_size'] == self.page_size:
+            kept = 0
+            for number, page in enumerate(manifest['pages'], 1):
+                entries = [[uid, updated] for uid, updated in page['entries'] if current.get(uid) == updated]
+                if len(entries) < len(page['entries']):
+                    page['entries'] = entries
+                    rewrite.add(number)
+                kept = kept + len(entries)
+            capacity = len(manifest['pages']) * self.page_size
+            if capacity and kept < capacity * (1 - PAGE_STALE_RATIO):
+                self.logger.info("{} of {} archived entries are out of date; starting new archive pages".format(capacity - kept, capacity))
+                obsolete = [page['filename'] for page in manifest['pages']]
+                manifest = None
+        elif manifest:
+            obsolete = [page['filename'] for page in manifest['pages']]
+            manifest = None
+
+        if manifest is None:
+            manifest = {'page_size': self.page_size,
+                        'generation': datetime.now(dateutil.tz.tzutc()).strftime('%Y%m%d%H%M%S'),
+                        'pages': []}
+            rewrite = set()
+
+        # move the oldest entries not yet archived into new archive pages,
+        # leaving at most page_size for the head
+        archived = set(uid for page in manifest['pages'] for uid, updated in page['entries'])
+        remaining = [doc for doc in docs if doc['uid'] not in archived]
+        old_count = len(manifest['pages'])
+        while len(remaining) > self.page_size:
+            page_docs, remaining = remaining[:self.page_size], remaining[self.page_size:]
+            filename = self._get_page_filename(manifest['generation'], len(manifest['pages']) + 1)
+            manifest['pages'].append({'filename': filename,
+                                      'entries': [[doc['uid'], current[doc['uid']]] for doc in page_docs]})
+            rewrite.add(len(manifest['pages']))
+        # the newest page from the last run now has a newer archive page to link to
+        if old_count and len(manifest['pages']) > old_count:
+            rewrite.add(old_count)
+
+        page_urls = ['{}{}'.format(self.feed_base_url, page['filename']) for page in manifest['pages']]
+        has_dups = False
+
+        # pages are numbered oldest first. next/prev-archive go to older
+        # entries, previous/next-archive to newer ones, ending at the head
+        for number in sorted(rewrite):
+            page = manifest['pages'][number - 1]
+            links = [('self', page_urls[number - 1]), ('current', self.s3_url), ('first', self.s3_url), ('last', page_urls[0])]
+            if number > 1:
+                links.extend([('next', page_urls[number - 2]), ('prev-archive', page_urls[number - 2])])
+            newer = page_urls[number] if number < len(page_urls) else self.s3_url
+            links.extend([('previous', newer), ('next-archive', newer)])
+            page_docs = [docs_by_uid[uid] for uid, updated in page['entries']]
+            filepath = os.path.join(self.dir, page['filename'])
+            has_dups = self._write_feed_streaming(page_docs, filepath, links, archive=True) or has_dups
+
+        links = [('self', self.s3_url), ('current', self.s3_url), ('first', self.s3_url)]
+        if page_urls:
+            links.extend([('next', page_urls[-1]), ('prev-archive', page_urls[-1]), ('last', page_urls[0])])
+        else:
+            links.append(('last', self.s3_url))
+        has_dups = self._write_feed_streaming(remaining, self.atom_filepath, links) or has_dups
+
+        filenames = [manifest['pages'][number - 1]['filename'] for number in sorted(rewrite)]
+        if not has_dups:
+            filenames.append(self._get_page_manifest_filename())
+            with open(os.path.join(self.dir, self._get_page_manifest_filename()), 'w') as f:
+                json.dump(manifest, f)
+
+        self.logger.info("Paged feed: {} archive pages ({} written), {} entries in head".format(
+            len(manifest['pages']), len(rewrite), len(remaining)))
+
+        # a generation started in the same second as the old one reuses its filenames
+        obsolete = [filename for filename in obsolete if filename not in filenames]
+
+        return has_dups, filenames, obsolete
+
+    def _remove_pages(self, filenames):
+        ''' remove archive pages of an old generation, once the head no longer links to them '''
+        for filename in filenames:
+            if self.nostash:
+                filepath = os.path.join(self.dir, filename)
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+            else:
+                bucketbase, keypath = self._s3_location(self.bucket, filename)
+                self.clients.s3().delete_object(Bucket=bucketbase, Key=keypath)
+        if filenames:
+            self.logger.info("Removed {} archive pages of an old generation".format(len(filenames)))
+
+    def _s3_location(self, bucket, filename):
+       """ Split a bucket/prefix string into the S3 bucket name and the key for filename """
+       bucketpath = bucket.strip("/")
+       bucketbase = bucket.split("/")[0]
        keyparts = bucketpath.split("/")[1:]
-       keyparts.append(self.atom_file)
+       keyparts.append(filename)
        keypath = '/'.join(keyparts)
 
-       s3 = boto3.client('s3')
-       response = s3.get_object(Bucket=bucketbase,Key=keypath)
-       contents = response['Body'].read()
+       return bucketbase, keypath
+
+    def _s3_get_feed(self):
+       """ Retrieve ATOM feed file from S3. Return as ElementTree object """
+       bucketbase, keypath = self._s3_location(self.bucket, self.atom_file)
+
+       s3 = self.clients.s3()
+       contents = self._s3_get_contents(s3.get_object(Bucket=bucketbase,Key=keypath))
+
+       # drop whitespace so reused entries pretty print the same as new ones
+       parser = etree.XMLParser(remove_blank_text=True)
+       return etree.fromstring(contents, parser)
+
+    def _s3_get_contents(self, response):
+        ''' body of an S3 get_object response, gunzipped if need be '''
+        contents = response['Body'].read()
+        if response.get('ContentEncoding') == 'gzip':
+            contents = gzip.GzipFile(fileobj=BytesIO(contents)).read()
+        return contents
+
+    def _s3_download_feed(self, filepath):
+        ''' download the published feed to filepath, gunzipped if need be '''
+        bucketbase, keypath = self._s3_location(self.bucket, self.atom_file)
+        response = self.clients.s3().get_object(Bucket=bucketbase, Key=keypath)
+        with open(filepath, 'wb') as f:
+            if response.get('ContentEncoding') == 'gzip':
+                f.write(self._s3_get_contents(response))
+            else:
+                shutil.copyfileobj(response['Body'], f)
+
+    def _get_previous_feed_filepath(self):
+        ''' where the published feed is downloaded to for an incremental run '''
+        return os.path.join(self.dir, 'ucldc_collection_{}.previous.atom'.format(self.collection_id))
+
+    def _load_previous_index(self):
+        ''' the entries of the currently published feed by dc:identifier, with
+            their parsed atom:updated and index record, from the feed's sidecar
+            index. The feed itself is downloaded to dir to copy reused entries
+            from, but not parsed. None if there's no index for the published feed '''
+        s3 = self.clients.s3()
+        bucketbase, index_keypath = self._s3_location(self.bucket, self._get_index_filename())
+        bucketbase, feed_keypath = self._s3_location(self.bucket, self.atom_file)
+        try:
+            lines = self._s3_get_contents(s3.get_object(Bucket=bucketbase, Key=index_keypath)).splitlines()
+            header = json.loads(lines[0])
+            feed_digest = s3.head_object(Bucket=bucketbase, Key=feed_keypath).get('Metadata', {}).get('feed-digest')
+        except (ClientError, ValueError, IndexError) as e:
+            self.logger.info("No feed index: {}".format(e))
+            return None
+
+        if header.get('version') != INDEX_VERSION or header.get('digest') != feed_digest:
+            self.logger.info("Feed index is out of date with the published feed")
+            return None
+        if header.get('scanned'):
+            self._previous_scanned = parse(header['scanned'])
+
+        entries = {}
+        for line in lines[1:]:
+            record = json.loads(line)
+            entries[record['id']] = (parse(record['updated']), record)
+
+        filepath = self._get_previous_feed_filepath()
+        self._s3_download_feed(filepath)
+        self._previous_feed_file = open(filepath, 'rb')
+
+        return entries
+
+    def _read_indexed_entry(self, record):
+        ''' copy an entry from the local copy of the published feed, given its
+            index record. None if the bytes there don't match the index '''
+        self._previous_feed_file.seek(record['offset'])
+        fragment = self._previous_feed_file.read(record['length'])
+        if hashlib.sha256(fragment).hexdigest() != record['sha256']:
+            self.logger.warning("Entry for {} doesn't match the feed index; rebuilding it".format(record['id']))
+            return None
 
-       return etree.fromstring(contents) 
+        return RawEntry(fragment, record['components'])
+
+    def _close_previous_feed(self):
+        ''' close the copy of the previous feed, removing it if it was downloaded '''
+        if self._previous_feed_file is not None:
+            self._previous_feed_file.close()
+            if self._previous_feed_file.name == self._get_previous_feed_filepath():
+                os.remove(self._previous_feed_file.name)
+            self._previous_feed_file = None
+
+    def _load_previous_entries(self):
+        ''' index the entries of the currently published feed (or a local copy
+            of it) by dc:identifier, with their parsed atom:updated. Uses the
+            feed's sidecar index if there is one, rather than scanning the feed.
+            Paged feeds don't have an index '''
+        if not self.previous_feed and not self.page_size:
+            entries = self._load_previous_index()
+            if entries is not None:
+                self.logger.info("Loaded {} entries from feed index".format(len(entries)))
+                return entries
+
+        filepath = self.previous_feed
+        try:
+            if not filepath:
+                filepath = self._get_previous_feed_filepath()
+                self._s3_download_feed(filepath)
+            entries = self._read_previous_feed(filepath)
+        except (IOError, ClientError, etree.XMLSyntaxError) as e:
+            self.logger.warning("Could not load existing feed for incremental update; rebuilding all entries: {}".format(e))
+            self._close_previous_feed()
+            if not self.previous_feed and os.path.exists(filepath):
+                os.remove(filepath)
+            return {}
+
+        self.logger.info("Loaded {} entries from existing feed".format(len(entries)))
+        return entries
+
+    def _read_previous_feed(self, filepath):
+        ''' entries of a local feed file by dc:identifier, with their parsed
+            atom:updated and index record. Only where each entry is in the
+            file is kept; the file is left open to copy reused entries from,
+            as with the sidecar index '''
+        entries = {}
+        for record in self._scan_feed_entries(filepath):
+            if record['id'] and record['updated']:
+                entries[record['id']] = (parse(record['updated']), record)
+
+        self._previous_feed_file = open(filepath, 'rb')
+        return entries
+
+    def _can_reuse_entry(self, document):
+        ''' check, without taking it, whether _reusable_entry will have an entry for a doc '''
+        uid = document['uid']
+        if self.checkpoint and uid in self.checkpoint.entries:
+            if self.checkpoint.entries[uid][0] == document['bundle_lastModified'].isoformat():
+                return True
+
+        if self.store and self.store.has_entry(uid, document['bundle_lastModified'].isoformat()):
+            return True
 
-    def _s3_stash(self):
-       """ Stash file in S3 bucket.
-       """
-       bucketpath = self.bucket.strip("/")
-       bucketbase = self.bucket.split("/")[0]
-       keyparts = bucketpath.split("/")[1:]
-       keyparts.append(self.atom_file)
-       keypath = '/'.join(keyparts)
+        previous = self.previous_entries.get(uid)
+        return previous is not None and document['bundle_lastModified'] <= previous[0]
+
+    def _reusable_entry(self, document):
+        ''' return the entry journaled by an interrupted run, stored by an
+            earlier run or published for a doc if the object hasn't changed
+            since, else None '''
+        if self.checkpoint:
+            fragment = self.checkpoint.take_entry(document['uid'], document['bundle_lastModified'].isoformat())
+            if fragment is not None:
+                self.stats.count('entries_resumed')
+                return self._parse_entry(fragment)
+
+        if self.store:
+            stored = self.store.get_entry(document['uid'], document['bundle_lastModified'].isoformat())
+            if stored is not None:
+                self.stats.count('store_entry_hits')
+                self.previous_entries.pop(document['uid'], None)
+                return self._parse_entry(stored)
+
+        if document['uid'] not in self.previous_entries:
+            return None
+
+        updated, entry = self.previous_entries.pop(document['uid'])
+        if document['bundle_lastModified'] > updated:
+            return None
+        if isinstance(entry, dict):
+            # where the entry is in the previous feed
+            entry = self._read_indexed_entry(entry)
+            if entry is None:
+                return None
+
+        self.reused_entries = self.reused_entries + 1
+        return entry
 
-       s3 = boto3.client('s3')
-       with open(self.atom_filepath, 'r') as f:
-           s3.upload_fileobj(f, bucketbase, keypath)
+    def _feed_digest(self, filepath):
+       """ sha256 of the feed file, ignoring the feed level <updated>, which changes on every run """
+       digest = hashlib.sha256()
+       skipped_updated = False
+       with open(filepath, 'rb') as f:
+           for line in f:
+               # feed <updated> is the first element at the top level of indentation
+               if not skipped_updated and line.startswith(b'  <updated>'):
+                   skipped_updated = True
+                   continue
+               digest.update(line)
+
+       return digest.hexdigest()
+
+    def _s3_stash(self, filepath=None, filename=None):
+       """ Stash file in S3 bucket, unless the feed there already has the same content.
+           Defaults to the feed file; filepath and filename are for the other files of a paged feed.
+           Returns True if the file was uploaded.
+       """
+       if filepath is None:
+           filepath, filename = self.atom_filepath, self.atom_file
+
+       bucketbase, keypath = self._s3_location(self.bucket, filename)
+       digest = self._feed_digest(filepath)
+       content_encoding = 'gzip' if self.gzip else None
+
+       s3 = self.clients.s3()
+       try:
+           response = s3.head_object(Bucket=bucketbase, Key=keypath)
+           if response.get('Metadata', {}).get('feed-digest') == digest and response.get('ContentEncoding') == content_encoding:
+               return False
+       except ClientError:
+           pass
+
+       extra_args = {'Metadata': {'feed-digest': digest}}
+       upload_filepath = filepath
+       if self.gzip:
+           extra_args['ContentEncoding'] = 'gzip'
+           upload_filepath = '{}.gz'.format(filepath)
+           with open(filepath, 'rb') as f_in:
+               f_out = gzip.open(upload_filepath, 'wb')
+               try:
+                   shutil.copyfileobj(f_in, f_out)
+               finally:
+                   f_out.close()
+
+       try:
+           with open(upload_filepath, 'rb') as f:
+               s3.upload_fileobj(f, bucketbase, keypath, ExtraArgs=extra_args)
+       finally:
+           if upload_filepath != filepath:
+               os.remove(upload_filepath)
+
+       return True
 
     def get_object_view_url(self, nuxeo_id):
         """ Get object view URL """
@@ -374,9 +1313,13 @@ class MerrittAtom():
      
         return url
 
+    def get_media_json_filename(self, nuxeo_id):
+        """ Get media.json (deep harvest) filename """
+        return "{}-media.json".format(nuxeo_id)
+
     def get_media_json_url(self, nuxeo_id):
         """ Get media.json (deep harvest) url """
-        url = "https://s3.amazonaws.com/{}/{}-media.json".format(MEDIA_JSON_BUCKET, nuxeo_id)
+        url = "https://s3.amazonaws.com/{}/{}".format(MEDIA_JSON_BUCKET, self.get_media_json_filename(nuxeo_id))
 
         return url
 
@@ -427,102 +1370,494 @@ class MerrittAtom():
 
         return all_md 
 
-    def _bundle_docs(self, docs):
-        ''' given a dict of parent level nuxeo docs, fetch any components
-            and also figure out when any part of the object was most 
-            recently modified/added '''
+    def _parse_date(self, date_str):
+        ''' parse a Nuxeo date string. The same timestamps turn up over and
+            over in a collection (batch imports), so parsed values are cached '''
+        parsed = self._parsed_dates.get(date_str)
+        if parsed is None:
+            parsed = parse(date_str)
+            self._parsed_dates[date_str] = parsed
+
+        return parsed
+
+    def _fetch_component_modified(self, docs, known=None):
+        ''' get the most recent modification time of any component of each
+            parent doc, keyed by parent uid. Rather than listing the components
+            of each object, this does one paged NXQL query for everything
+            under the collection path modified since the oldest parent.
+            known is a list of (since, {uid: bundle_lastModified}) from earlier
+            runs that had looked at all components modified before since;
+            objects listed there only need components modified after that. '''
+        self.scanned = datetime.now(dateutil.tz.tzutc())
+        if not docs:
+            return {}
+
+        parents_by_path = dict((doc['path'], doc['uid']) for doc in docs)
+        oldest = None
+        for doc in docs:
+            needed = doc['bundle_lastModified']
+            for since, values in known or []:
+                if doc['uid'] in values and since > needed:
+                    needed = since
+            if oldest is None or needed < oldest:
+                oldest = needed
+        oldest = oldest.astimezone(dateutil.tz.tzutc()).strftime('%Y-%m-%d %H:%M:%S+00:00')
+        query = MODIFIED_SINCE_NXQL.format(self.path.rstrip('/').replace("'", "\\'"), oldest)
+
+        self.stats.count('nuxeo_queries')
+        # plain REST search, so that only the dublincore schema comes back.
+        # each result page is retried on its own
+        fetcher = NuxeoFetcher(self.nx.conf, 1, properties=MODIFIED_SINCE_PROPERTIES, retry=self.clients.nuxeo_retry)
+        try:
+            results = fetcher.search(query)
+        finally:
+            fetcher.close()
+
+        component_modified = {}
+        for c in results:
+            # walk up the path to find the parent object. components may be nested
+            parent_uid = None
+            path = c['path']
+            while '/' in path:
+                path = path.rsplit('/', 1)[0]
+                if path in parents_by_path:
+                    parent_uid = parents_by_path[path]
+                    break
+            if parent_uid is None:
+                continue
+
+            mod_datetime = self._parse_date(c['lastModified'])
+            if parent_uid not in component_modified or mod_datetime > component_modified[parent_uid]:
+                component_modified[parent_uid] = mod_datetime
+
+        return component_modified
+
+    def _project_docs(self, docs):
+        ''' replace the fetched docs with DocRecords, freeing each full doc as it goes '''
+        records = []
+        docs.reverse()
+        while docs:
+            records.append(DocRecord(docs.pop()))
+
+        return records
+
+    def _bundle_docs(self, docs, known=None):
+        ''' given a dict of parent level nuxeo docs, figure out when any part
+            of each object, including its components, was most recently
+            modified/added. known is as for _fetch_component_modified '''
+        self._parsed_dates = {}
 
         for doc in docs:
+            doc['bundle_lastModified'] = self._parse_date(doc['lastModified'])
 
-            last_mod_str = doc['lastModified']
-            overall_mod_datetime = parse(last_mod_str)
+        component_modified = self._fetch_component_modified(docs, known)
 
-            doc['components'] = []
-            
-            for c in doc['components']:
-                mod_str = c['lastModified']
-                mod_datetime = parse(mod_str)
-        
-                if mod_datetime > overall_mod_datetime:
-                    overall_mod_datetime = mod_datetime 
+        for doc in docs:
+            candidates = [component_modified.get(doc['uid'])]
+            candidates.extend(values.get(doc['uid']) for since, values in known or [])
+            for mod_datetime in candidates:
+                if mod_datetime and mod_datetime > doc['bundle_lastModified']:
+                    doc['bundle_lastModified'] = mod_datetime
 
-            doc['bundle_lastModified'] = overall_mod_datetime
+        self._parsed_dates = {}
 
         return docs 
 
     def has_duplicates(self, root):
         ''' check to see if there are duplicate entries in the feed '''
-        feed = root.iterfind('{http://www.w3.org/2005/Atom}feed/')
-        ids = root.iter("{http://purl.org/dc/elements/1.1/}identifier")
+        seen_ids = set()
+        for identifier in root.iter(etree.QName(DC_NS, "identifier").text):
+            if identifier.text in seen_ids:
+                return True
+            seen_ids.add(identifier.text)
+
+        return False
+
+    def _has_duplicate_entries(self):
+        ''' check whether any object got more than one entry while building the feed '''
+        return bool(self.entry_ids.duplicate_parents) and not self.dedup
+
+    def _entry_component_ids(self, uid, entry):
+        ''' uids of the components listed in an entry, from their full metadata links '''
+        if isinstance(entry, RawEntry):
+            return list(entry.components)
+
+        component_ids = []
+        for link in entry.iterfind(etree.QName(ATOM_NS, "link").text):
+            if link.get('type') == 'application/xml' and link.get('href', '').endswith('.xml'):
+                component_uid = link.get('href').rsplit('/', 1)[-1][:-len('.xml')]
+                if component_uid != uid:
+                    component_ids.append(component_uid)
+
+        return component_ids
+
+    def _skip_duplicate_docs(self, docs):
+        ''' yield docs, recording each object as its entry is started. A repeated
+            object is dropped before its entry is built if deduplicating '''
+        for document in docs:
+            if not self.entry_ids.add_parent(document['uid']):
+                self.logger.warning("Duplicate entry for object {} {}{}".format(
+                    document['uid'], document['path'], "; dropping it" if self.dedup else ""))
+                if self.dedup:
+                    continue
+            yield document
+
+
+    def _build_entry(self, document, errors=None):
+        ''' construct the feed entry for a bundled doc '''
+        if errors:
+            raise RuntimeError("Entry construction aborted after an error in another worker")
+
+        nxid = document['uid']
+        self.logger.info("working on document: {} {}".format(nxid, document['path']))
 
-        count = 0
-        idlist = []
-        for identifier in ids:
-            count = count + 1
-            #print(identifier.text), count
-            idlist.append(identifier.text)
+        try:
+            # object, bundled into one <entry> if complex
+            with self.stats.phase('build_entries'):
+                entry = self._construct_entry_bundled(document)
+            self.stats.count('entries_built')
+            self._queue_media_json(document)
+            return entry
+        except Exception as e:
+            if errors is not None:
+                self.logger.exception("Failed to build entry for {} {}".format(nxid, document['path']))
+                errors.append(e)
+            raise
+
+    def _media_json_is_current(self, s3, document):
+        ''' check whether the media.json on s3 was stashed after the object was last modified '''
+        bucketbase, keypath = self._s3_location(MEDIA_JSON_BUCKET, self.get_media_json_filename(document['uid']))
+        try:
+            response = s3.head_object(Bucket=bucketbase, Key=keypath)
+        except ClientError:
+            return False
 
-        dups = [item for item, count in collections.Counter(idlist).items() if count > 1]
+        return response['LastModified'] >= document['bundle_lastModified']
 
-        if len(dups) > 0:
-            return True
-        else:
-            return False
+    def _stash_media_json(self, s3, document):
+        ''' create and stash media.json for a bundled doc, unless the one on s3
+            is already current. Returns (uid, status, error) '''
+        nxid = document['uid']
+        try:
+            if self._media_json_is_current(s3, document):
+                return nxid, 'current', None
+
+            nxstash = NuxeoStashMediaJson(
+               document['path'],
+               MEDIA_JSON_BUCKET,
+               MEDIA_JSON_REGION)
+            nxstash.nxstashref()
+            return nxid, 'stashed', None
+        except Exception as e:
+            self.logger.exception("Failed to stash media.json for {} {}".format(nxid, document['path']))
+            return nxid, 'failed', str(e)
+
+    def _start_media_json_stash(self):
+        ''' start a separate worker pool for stashing media.json, so that
+            uploads run alongside feed generation '''
+        self._stash_s3 = self.clients.s3(region_name=MEDIA_JSON_REGION)
+        self._stash_pool = ThreadPool(max(self.workers, 1))
+        self._stash_results = []
+
+    def _queue_media_json(self, document):
+        ''' queue media.json for a doc to be stashed, as soon as its entry is in hand '''
+        if self.nostash:
+            return
+
+        callback = None
+        if self.checkpoint:
+            updated = document['bundle_lastModified'].isoformat()
+            if self.checkpoint.has_media_json(document['uid'], updated):
+                self.stats.count('media_json_resumed')
+                return
+
+            def callback(result):
+                uid, status, error = result
+                if status != 'failed':
+                    self.checkpoint.add_media_json(uid, updated)
+
+        self._stash_results.append(self._stash_pool.apply_async(self._stash_media_json, (self._stash_s3, document), callback=callback))
+
+    def _finish_media_json_stash(self):
+        ''' wait for media.json stashing to finish and report per object failures '''
+        self._stash_pool.close()
+        self._stash_pool.join()
+        statuses = [result.get() for result in self._stash_results]
+        self._stash_pool = self._stash_results = None
+
+        counts = collections.Counter(status for uid, status, error in statuses)
+        for status in ('stashed', 'current', 'failed'):
+            self.stats.count('media_json_{}'.format(status), counts[status])
+        self.media_json_failures = dict((uid, error) for uid, status, error in statuses if status == 'failed')
+        self.logger.info("media.json: {} stashed, {} already current, {} failed".format(
+            counts['stashed'], counts['current'], counts['failed']))
+        for uid, error in self.media_json_failures.items():
+            self.logger.warning("media.json not stashed for {}: {}".format(uid, error))
+
+    def _iter_entries(self, docs):
+        ''' yield (doc, entry) for each doc, in the same order as docs, checking
+            for repeated objects and components as it goes '''
+        docs = self._skip_duplicate_docs(docs)
+        if self.fetcher:
+            # components for entries that will be reused aren't needed
+            docs = self.fetcher.prefetch(docs, self._component_query, skip=self._can_reuse_entry)
+
+        for document, entry in self._iter_built_entries(docs):
+            with self.stats.phase('dup_check'):
+                component_ids = self._entry_component_ids(document['uid'], entry)
+                repeats = self.entry_ids.add_components(document['uid'], component_ids)
+            self._index_components[document['uid']] = component_ids
+            if repeats:
+                self.logger.warning("Components of object {} {} already in feed: {}".format(
+                    document['uid'], document['path'], ', '.join(repeats)))
+            if self.checkpoint and document['uid'] not in self.checkpoint.resumed:
+                self.checkpoint.add_entry(document['uid'], document['bundle_lastModified'].isoformat(), self._serialize_entry(entry))
+            yield document, entry
+
+    def _iter_built_entries(self, docs):
+        ''' yield (doc, entry) for each doc, in the same order as docs.
+            With more than one worker, entries are built concurrently on a
+            bounded thread pool. The first error stops any remaining work and
+            is raised here. '''
+        if self.workers < 2:
+            for document in docs:
+                entry = self._reusable_entry(document)
+                if entry is None:
+                    entry = self._build_entry(document)
+                else:
+                    self._queue_media_json(document)
+                yield document, entry
+            return
+
+        pool = ThreadPool(self.workers)
+        errors = []
+        pending = collections.deque()
+
+        def next_result():
+            document, entry, result = pending.popleft()
+            if entry is not None:
+                return document, entry
+            try:
+                return document, result.get()
+            except Exception:
+                # surface the original failure rather than an aborted task
+                if errors:
+                    raise errors[0]
+                raise
 
+        try:
+            for document in docs:
+                if errors:
+                    break
+                entry = self._reusable_entry(document)
+                if entry is not None:
+                    self._queue_media_json(document)
+                    pending.append((document, entry, None))
+                else:
+                    pending.append((document, None, pool.apply_async(self._build_entry, (document, errors))))
+                # keep a bounded number of entries in flight
+                if len(pending) >= self.workers * 2:
+                    yield next_result()
+
+            while pending:
+                yield next_result()
+        finally:
+            pool.terminate()
+            pool.join()
 
     def process_feed(self):
-        ''' create feed for collection and stash on s3 '''
+        ''' create feed for collection and stash on s3. Time spent per phase and
+            counters for the run are logged as a JSON summary and kept in self.summary '''
+        self.stats = FeedStats()
+        s3_before = self.clients.s3_stats()
+        started = time.time()
+        status = 'ERROR'
+        try:
+            status = self._process_feed()
+            return status
+        finally:
+            if self.fetcher:
+                self.stats.count('nuxeo_prefetch_requests', self.fetcher.requests)
+                self.fetcher.close()
+                self.fetcher = None
+            if self.store:
+                self.store.close()
+                self.store = None
+            self._close_previous_feed()
+            if self.checkpoint:
+                # kept for a resumed run
+                self.checkpoint.close()
+                self.checkpoint = None
+            self.stats.add_time('total', time.time() - started)
+            self.summary = self._summarize(status, s3_before)
+            self.logger.info("Feed summary: {}".format(json.dumps(self.summary)))
+
+    def _summarize(self, status, s3_before):
+        ''' summary of the last run, with the S3 calls made since s3_before '''
+        summary = self.stats.summary()
+        summary['collection_id'] = self.collection_id
+        summary['status'] = status
+        summary['entries'] = self.entry_count
+        summary['counters']['entries_reused'] = self.reused_entries
+        summary['metadata_cache'] = self.md_cache.stats()
+
+        summary['s3'] = {}
+        for name, value in self.clients.s3_stats().items():
+            before = s3_before.get(name, {'calls': 0, 'seconds': 0})
+            if value['calls'] > before['calls']:
+                summary['s3'][name] = {'calls': value['calls'] - before['calls'],
+                                       'seconds': round(value['seconds'] - before['seconds'], 3)}
+
+        return summary
+
+    def _process_feed(self):
         self.logger.info("atom_file: {}".format(self.atom_file))
         self.logger.info("Nuxeo path: {}".format(self.path))
         self.logger.info("Fetching Nuxeo docs. This could take a while if collection is large...")
 
-        parent_docs = self.dh.fetch_objects()
+        with self.stats.phase('fetch_objects'):
+            parent_docs = self._project_docs(self.clients.nuxeo_retry.call_listing(self.dh.fetch_objects))
+
+        # loaded before bundling: objects in the published feed or the
+        # checkpoint only need components modified since those were made
+        known = []
+        if self.incremental:
+            with self.stats.phase('load_previous'):
+                self.previous_entries = self._load_previous_entries()
+            self.reused_entries = 0
+            if self._previous_scanned:
+                known.append((self._previous_scanned - timedelta(seconds=SCAN_MARGIN),
+                              dict((uid, value[0]) for uid, value in self.previous_entries.items())))
+
+        if self.resume:
+            self.checkpoint = Checkpoint(os.path.join(self.dir, self._get_checkpoint_filename()))
+            self.checkpoint.load()
+            if self.checkpoint.entries or self.checkpoint.media_json:
+                self.logger.info("Resuming from checkpoint: {} entries, {} media.json already done".format(
+                    len(self.checkpoint.entries), len(self.checkpoint.media_json)))
+            if self.checkpoint.scanned:
+                known.append((self.checkpoint.scanned - timedelta(seconds=SCAN_MARGIN),
+                              dict((uid, parse(value[0])) for uid, value in self.checkpoint.entries.items())))
+            self.checkpoint.open()
+
+        with self.stats.phase('bundle'):
+            bundled_docs = self._bundle_docs(parent_docs, known)
+            bundled_docs.sort(key=itemgetter('bundle_lastModified'))
+        self.entry_count = len(bundled_docs)
+        if self.checkpoint:
+            self.checkpoint.add_scanned(self.scanned)
 
-        bundled_docs = self._bundle_docs(parent_docs)
-        bundled_docs.sort(key=itemgetter('bundle_lastModified'))
+        if not self.nostash:
+            self._start_media_json_stash()
 
-        # create root
-        root = etree.Element(etree.QName(ATOM_NS, "feed"), nsmap=NS_MAP)
+        if self.fetch_concurrency:
+            self.fetcher = NuxeoFetcher(self.nx.conf, self.fetch_concurrency, self.fetch_connections, retry=self.clients.nuxeo_retry)
 
-        # add entries
-        for document in bundled_docs:
-            nxid = document['uid']
-            self.logger.info("working on document: {} {}".format(nxid, document['path']))
+        if self.metadata_store:
+            self.store = MetadataStore(self.metadata_store, context='{} {}'.format(ENTRY_FORMAT, self.nx.conf['api']))
 
-            # create and stash media.json
+        self.entry_ids = EntryIds()
+        self._index_components = {}
+        page_files = []
+        obsolete_pages = []
+        try:
+            # includes building entries, unless they were all built up front
+            with self.stats.phase('write'):
+                if self.page_size:
+                    has_dups, page_files, obsolete_pages = self._write_paged_feed(bundled_docs)
+                elif self.stream:
+                    has_dups = self._write_feed_streaming(bundled_docs)
+                else:
+                    with self.stats.phase('build'):
+                        root = self._build_feed(bundled_docs)
+                    self._write_feed(root)
+                    has_dups = self._has_duplicate_entries()
+        except Exception:
             if not self.nostash:
-               nxstash = NuxeoStashMediaJson(
-                  document['path'],
-	          MEDIA_JSON_BUCKET,
-                  MEDIA_JSON_REGION)
-               nxstash.nxstashref()
-
-            # object, bundled into one <entry> if complex
-            entry = self._construct_entry_bundled(document)
-            self.logger.info("inserting entry for object {} {}".format(nxid, document['path']))
-            root.insert(0, entry)
+                self._stash_pool.terminate()
+            raise
 
-        # add header info
-        logging.info("Adding header info to xml tree")
-        self._add_merritt_id(root, self.merritt_id)
-        self._add_paging_info(root)
-        self._add_collection_alt_link(root, self.path)
-        self._add_atom_elements(root)
-        self._add_feed_updated(root, datetime.now(dateutil.tz.tzutc()).isoformat())
-
-        self._write_feed(root)
         logging.info("Feed written to file: {}".format(self.atom_filepath))
+        self.stats.count('feed_bytes', sum(os.path.getsize(os.path.join(self.dir, filename))
+                                           for filename in [self.atom_file] + page_files))
+        if self.incremental:
+            # anything left over is for an object no longer in the collection
+            self.logger.info("Incremental update: {} entries reused, {} rebuilt, {} removed".format(
+                self.reused_entries, len(bundled_docs) - self.reused_entries, len(self.previous_entries)))
+            self.previous_entries = {}
+        self.logger.info("Feed ids: {}".format(self.entry_ids.stats()))
+        self.logger.info("Metadata cache stats: {}".format(self.md_cache.stats()))
+        self.logger.info("Client stats: {}".format(self.clients.stats()))
+
+        if not self.nostash:
+            # media.json is stashed alongside the build; this is the wait for what's left
+            with self.stats.phase('stash_media_json'):
+                self._finish_media_json_stash()
 
-        if self.has_duplicates(root):
+        if has_dups:
             self.logger.warning("Duplicates in feed {}. Will not stash on S3.".format(self.atom_filepath))
+            self._remove_checkpoint()
             return 'DUPS'
 
-        if not self.nostash:
-            self._s3_stash()
-            self.logger.info("Feed stashed on s3: {}".format(self.s3_url)) 
+        # an index of a paged feed would only cover the head page, so paged
+        # feeds don't get one
+        index_file = None
+        if not self.page_size:
+            with self.stats.phase('index'):
+                index_file = self._write_feed_index()
+        self._index_components = {}
 
+        if not self.nostash:
+            with self.stats.phase('upload'):
+                # archive pages go up before the head page that links to them
+                for filename in page_files:
+                    self._s3_stash(os.path.join(self.dir, filename), filename)
+                if self._s3_stash():
+                    self.logger.info("Feed stashed on s3: {}".format(self.s3_url))
+                else:
+                    self.logger.info("Feed unchanged; not stashing on s3: {}".format(self.s3_url))
+                if index_file:
+                    # after the feed it describes
+                    self._s3_stash(os.path.join(self.dir, index_file), index_file)
+
+        # once nothing links to them
+        self._remove_pages(obsolete_pages)
+
+        self._remove_checkpoint()
         return 'OK'
 
+# MerrittAtom kwargs that the feed scripts take as command line options
+FEED_OPTIONS = ('pynuxrc', 'bucket', 'dir', 'nostash', 'workers', 'stream', 'incremental', 'gzip', 'page_size',
+                'dedup', 'resume', 'fetch_concurrency', 'fetch_connections', 'metadata_store', 'registry_cache')
+
+def add_feed_arguments(parser):
+    ''' add the command line options for FEED_OPTIONS to an argparse parser '''
+    parser.add_argument("--pynuxrc", help="rc file for use by pynux")
+    parser.add_argument("--bucket", help="S3 bucket where feed is stashed")
+    parser.add_argument("--dir", help="local directory where feed is written" )
+    parser.add_argument("--nostash", action='store_true', help="write feed to local directory and do not stash on S3")
+    parser.add_argument("--workers", type=int, help="number of threads used to build feed entries concurrently")
+    parser.add_argument("--stream", action='store_true', help="write feed entries to file as they are built rather than holding the whole feed in memory")
+    parser.add_argument("--incremental", action='store_true', help="reuse entries from the published feed for objects that haven't changed")
+    parser.add_argument("--gzip", action='store_true', help="upload feed to S3 gzip-encoded")
+    parser.add_argument("--page-size", type=int, help="split feed into RFC 5005 archive pages of this many entries")
+    parser.add_argument("--dedup", action='store_true', help="drop repeated entries and stash the feed anyway, rather than refusing to stash it")
+    parser.add_argument("--resume", action='store_true', help="checkpoint progress in --dir and pick up from the last checkpoint if an earlier run failed")
+    parser.add_argument("--fetch-concurrency", type=int, help="number of Nuxeo requests for components to keep in flight ahead of building entries")
+    parser.add_argument("--fetch-connections", type=int, help="maximum connections to Nuxeo for --fetch-concurrency")
+    parser.add_argument("--metadata-store", help="directory for keeping Nuxeo metadata and built entries between runs, so unchanged objects aren't fetched again")
+    parser.add_argument("--registry-cache", help="directory for caching registry API responses between runs")
+
+def feed_kwargs(argv):
+    ''' MerrittAtom kwargs for the options given on a command line parsed with add_feed_arguments '''
+    kwargs = {}
+    for name in FEED_OPTIONS:
+        value = getattr(argv, name)
+        if value:
+            kwargs[name] = value
+
+    return kwargs
+
 def main(argv=None):
     pass
 
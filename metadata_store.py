@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import logging
+import sqlite3
+import threading
+from os.path import expanduser
+
+""" On-disk store of what was extracted from Nuxeo for each object, kept between feed runs. """
+STORE_FILENAME = 'metadata_store.sqlite'
+# drop objects that haven't been used by a run for this many seconds
+STORE_MAX_AGE = 30 * 24 * 3600
+# and keep at most this many, dropping the least recently used
+STORE_MAX_OBJECTS = 2000000
+
+class MetadataStore():
+    ''' SQLite store of the component metadata and rendered entry for each
+        object, keyed by Nuxeo uid and the time any part of the object was
+        last modified. A run that finds an object unchanged since it was
+        stored can reuse these instead of fetching the object's components
+        again. context identifies how objects were fetched and entries rendered
+        (e.g. the Nuxeo host); nothing stored for another context is used.
+        Safe to share between threads, and between processes using the same
+        cache_dir: each write is committed as soon as it's made, so no
+        transaction is held open while a feed is built. When stored objects
+        were used is only recorded on close, in one short transaction. '''
+
+    def __init__(self, cache_dir, context='', max_age=STORE_MAX_AGE, max_objects=STORE_MAX_OBJECTS):
+        self.logger = logging.getLogger(__name__)
+        self.context = context
+        self.max_age = max_age
+        self.max_objects = max_objects
+
+        cache_dir = expanduser(cache_dir)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        self.filepath = os.path.join(cache_dir, STORE_FILENAME)
+
+        self._lock = threading.Lock()
+        # uids of the objects used this run, for close to mark as recently used
+        self._used = set()
+        self._db = sqlite3.connect(self.filepath, timeout=60, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS objects ('
+                         'uid TEXT PRIMARY KEY, modified TEXT NOT NULL, context TEXT NOT NULL, '
+                         'components TEXT NOT NULL, entry BLOB, used REAL NOT NULL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS objects_used ON objects (used)')
+        self._db.commit()
+
+    def _row(self, uid, modified, columns):
+        with self._lock:
+            return self._db.execute('SELECT {} FROM objects WHERE uid = ? AND modified = ?'.format(columns),
+                                    (uid, modified)).fetchone()
+
+    def _write(self, statement, parameters):
+        with self._lock:
+            self._db.execute(statement, parameters)
+            self._db.commit()
+
+    def has_entry(self, uid, modified):
+        ''' check whether an entry is stored for an object as of modified '''
+        row = self._row(uid, modified, 'context, entry')
+        return row is not None and row[0] == self.context and row[1] is not None
+
+    def get_entry(self, uid, modified):
+        ''' serialized entry stored for an object as of modified, or None '''
+        row = self._row(uid, modified, 'context, entry')
+        if row is None or row[0] != self.context or row[1] is None:
+            return None
+
+        self._touch(uid)
+        return str(row[1])
+
+    def get_components(self, uid, modified):
+        ''' component metadata stored for an object as of modified, or None '''
+        row = self._row(uid, modified, 'context, components')
+        if row is None or row[0] != self.context:
+            return None
+
+        self._touch(uid)
+        return json.loads(row[1])
+
+    def _touch(self, uid):
+        with self._lock:
+            self._used.add(uid)
+
+    def _save_used(self):
+        ''' mark the objects used this run as used now '''
+        with self._lock:
+            used = time.time()
+            self._db.executemany('UPDATE objects SET used = ? WHERE uid = ?', ((used, uid) for uid in self._used))
+            self._db.commit()
+            self._used = set()
+
+    def put(self, uid, modified, components, entry=None):
+        ''' store what was fetched and built for an object as of modified,
+            replacing anything stored for an earlier version of it '''
+        self._write('INSERT OR REPLACE INTO objects (uid, modified, context, components, entry, used) '
+                    'VALUES (?, ?, ?, ?, ?, ?)',
+                    (uid, modified, self.context, json.dumps(components),
+                     sqlite3.Binary(entry) if entry is not None else None,
+                     time.time()))
+
+    def evict(self):
+        ''' drop objects not used within max_age, then the least recently used
+            beyond max_objects. Returns the number dropped '''
+        with self._lock:
+            dropped = self._db.execute('DELETE FROM objects WHERE used < ?', (time.time() - self.max_age,)).rowcount
+            count = self._db.execute('SELECT COUNT(*) FROM objects').fetchone()[0]
+            if count > self.max_objects:
+                dropped = dropped + self._db.execute(
+                    'DELETE FROM objects WHERE uid IN (SELECT uid FROM objects ORDER BY used LIMIT ?)',
+                    (count - self.max_objects,)).rowcount
+            self._db.commit()
+
+        return dropped
+
+    def close(self):
+        ''' record which objects were used, evict and close '''
+        self._save_used()
+        dropped = self.evict()
+        if dropped:
+            self.logger.info("Evicted {} objects from metadata store {}".format(dropped, self.filepath))
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import collections
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from multiprocessing.pool import ThreadPool
+from resilience import RetryPolicy
+
+""" Concurrent NXQL searches against the Nuxeo REST API, run ahead of feed entry construction. """
+FETCH_CONCURRENCY = 32
+SEARCH_PAGE_SIZE = 100
+
+class NuxeoFetcher():
+    ''' Runs a per-object NXQL search (e.g. for its components) over plain
+        HTTP with many requests in flight, so that entry construction doesn't
+        wait on Nuxeo one object at a time. Connections are capped per host;
+        prefetch() runs at most window objects ahead of whoever consumes it,
+        which bounds both memory and the load on Nuxeo. Each request goes
+        through retry, whose limiter can hold back fewer than concurrency
+        requests if Nuxeo is struggling. '''
+
+    def __init__(self, conf, concurrency=FETCH_CONCURRENCY, connections=None, properties=None, retry=None):
+        self.api = conf['api']
+        self.auth = (conf['user'], conf['password'])
+        self.headers = {'X-NXDocumentProperties': properties or conf.get('X-NXDocumentProperties', '*')}
+
+        connections = connections or concurrency
+        self.session = requests.Session()
+        # block rather than open more connections to a host than the cap
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+        self.retry = retry if retry else RetryPolicy()
+        self.concurrency = concurrency
+        self._pool = ThreadPool(concurrency)
+        self._results = {}
+        self._lock = threading.Lock()
+        self.requests = 0
+
+    def search(self, query):
+        ''' all documents matching an NXQL query, following result pages '''
+        url = u'{}/path/@search'.format(self.api)
+        documents = []
+        page_index = 0
+        while True:
+            params = {'query': query, 'pageSize': SEARCH_PAGE_SIZE, 'currentPageIndex': page_index}
+            md = self.retry.call(self._get_json, url, params)
+            documents.extend(md['entries'])
+            if not md.get('isNextPageAvailable'):
+                return documents
+            page_index = page_index + 1
+
+    def _get_json(self, url, params):
+        res = self.session.get(url, params=params, headers=self.headers, auth=self.auth)
+        with self._lock:
+            self.requests = self.requests + 1
+        res.raise_for_status()
+        return json.loads(res.content)
+
+    def prefetch(self, docs, query, window=None, skip=None):
+        ''' yield docs in order, having started the search for each (the NXQL
+            given by query(doc)) up to window docs ahead. skip(doc) marks docs
+            whose results won't be needed '''
+        window = window or self.concurrency * 2
+        pending = collections.deque()
+        for doc in docs:
+            if not (skip and skip(doc)):
+                with self._lock:
+                    self._results[doc['uid']] = self._pool.apply_async(self.search, (query(doc),))
+            pending.append(doc)
+            if len(pending) > window:
+                yield pending.popleft()
+
+        while pending:
+            yield pending.popleft()
+
+    def results(self, uid):
+        ''' search results prefetched for an object, waiting for them if need
+            be, or None if it wasn't prefetched. Fetch errors are raised here '''
+        with self._lock:
+            result = self._results.pop(uid, None)
+        if result is None:
+            return None
+
+        return result.get()
+
+    def close(self):
+        self._pool.terminate()
+        self._pool.join()
+        with self._lock:
+            self._results = {}
+        self.session.close()
@@ -2,14 +2,31 @@
 # -*- coding: utf-8 -*-
 
 import sys, os
+import re
 import logging
 import boto3
 import argparse
-from merritt_atom import MerrittAtom
-import requests
+from merritt_atom import MerrittAtom, BUCKET, add_feed_arguments, feed_kwargs
 import json
+from registry import RegistryClient
+import time
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+from clients import Clients
+from botocore.exceptions import ClientError
 
-REGISTRY_BASE = 'https://registry.cdlib.org/'
+COUNT_NXQL = "SELECT * FROM Document WHERE ecm:path STARTSWITH '{}' AND ecm:isTrashed = 0"
+# trashed documents are included, so that an object being trashed counts as a change
+CHANGED_NXQL = "SELECT * FROM Document WHERE ecm:path STARTSWITH '{}' AND dc:modified >= TIMESTAMP '{}'"
+# look for changes this many seconds before the last refresh, in case the Nuxeo clock is behind ours
+CHANGE_MARGIN = 600
+# a collection's feed, or the head page of a paged feed. archive pages are
+# ucldc_collection_<id>_<generation>_<number>.atom
+FEED_KEY_RE = re.compile(r'^ucldc_collection_([^_.]+)\.atom$')
+
+# clients shared by all collections refreshed in a pool worker process
+worker_clients = None
 
 numeric_level = getattr(logging, 'INFO', None)
 logging.basicConfig(
@@ -23,57 +40,273 @@ logger = logging.getLogger(__name__)
 def main():
 
     parser = argparse.ArgumentParser(description='refresh merritt atom feeds')
-    parser.add_argument("--pynuxrc", help="rc file for use by pynux")
-    parser.add_argument("--bucket", help="S3 bucket where feed is stashed")
-    parser.add_argument("--dir", help="local directory where feed is written" )
-    parser.add_argument("--nostash", action='store_true', help="write feed to local directory and do not stash on S3")
+    add_feed_arguments(parser)
+    parser.add_argument("--processes", type=int, default=1, help="number of collections to refresh in parallel")
+    parser.add_argument("--time-budget", type=int, help="stop refreshing after this many seconds")
+    parser.add_argument("--report", help="file to write per collection status report (JSON) to")
+    parser.add_argument("--state", help="JSON file recording when each collection was last refreshed successfully")
+    parser.add_argument("--changed-only", action='store_true', help="only refresh collections with Nuxeo changes since they were last refreshed according to --state, or whose feed is missing")
 
     argv = parser.parse_args()
 
-    kwargs = {}
-    if argv.pynuxrc:
-        kwargs['pynuxrc'] = argv.pynuxrc
-    if argv.bucket:
-        kwargs['bucket'] = argv.bucket
-    if argv.dir:
-        kwargs['dir'] = argv.dir
-    if argv.nostash:
-        kwargs['nostash'] = argv.nostash
+    if argv.changed_only and not argv.state:
+        parser.error("--changed-only needs --state")
+
+    kwargs = feed_kwargs(argv)
 
-    feeds = get_feed_info()
+    registry = RegistryClient(cache_dir=argv.registry_cache)
+    feeds = registry.get_feed_info()
 
     # create and stash new feed for each collection
-    for key, value in feeds.items():
-        ma = MerrittAtom(key, merritt_id=value['merritt_id'], nuxeo_path=value['nuxeo_endpoint'], **kwargs)
-        ma.process_feed()
+    statuses = refresh_tracked(feeds, kwargs, argv.state, argv.changed_only, processes=argv.processes, time_budget=argv.time_budget)
+    report_statuses(statuses, argv.report)
+
+def load_state(filepath):
+    ''' collection id -> {'refreshed': time of the last successful refresh} '''
+    try:
+        with open(filepath, 'r') as f:
+            return json.load(f)
+    except IOError:
+        return {}
+
+def save_state(filepath, state):
+    state_dir = os.path.dirname(os.path.abspath(filepath))
+    if not os.path.isdir(state_dir):
+        os.makedirs(state_dir)
+
+    tmp_filepath = '{}.{}.tmp'.format(filepath, os.getpid())
+    with open(tmp_filepath, 'w') as f:
+        json.dump(state, f, indent=2, sort_keys=True)
+    os.rename(tmp_filepath, filepath)
+
+def feed_exists(clients, collection_id, kwargs):
+    ''' check whether a collection's feed has been written, on S3 or in the local directory if not stashing '''
+    filename = 'ucldc_collection_{}.atom'.format(collection_id)
+    if kwargs.get('nostash'):
+        return os.path.exists(os.path.join(kwargs.get('dir', '.'), filename))
+
+    bucketpath = kwargs.get('bucket', BUCKET).strip('/')
+    bucketbase = bucketpath.split('/')[0]
+    keypath = '/'.join(bucketpath.split('/')[1:] + [filename])
+    try:
+        clients.s3().head_object(Bucket=bucketbase, Key=keypath)
+    except ClientError:
+        return False
+
+    return True
+
+def changed_collections(clients, feeds, state, kwargs, threads=8):
+    ''' pick out the collections that need refreshing: those with documents
+        modified since their last successful refresh, those never refreshed
+        and those whose feed is missing. One single-row NXQL search per
+        collection. Returns a dict of collection id -> reason '''
+    nx = clients.nuxeo(kwargs.get('pynuxrc'))
+    registry = RegistryClient(cache_dir=kwargs.get('registry_cache'), session=clients.session, retry=clients.retry)
 
-def get_feed_info():
-    ''' get list of collections for which to create feeds, based on registry info '''
+    def check(item):
+        collection_id, value = item
+        refreshed = state.get(collection_id, {}).get('refreshed')
+        if not refreshed:
+            return collection_id, 'new'
+        try:
+            if not feed_exists(clients, collection_id, kwargs):
+                return collection_id, 'feed missing'
+            # feeds found on S3 don't come with registry info
+            path = value.get('nuxeo_endpoint') or registry.get_collection(collection_id, save=False)['harvest_extra_data']
+            since = time.strftime('%Y-%m-%d %H:%M:%S+00:00', time.gmtime(refreshed - CHANGE_MARGIN))
+            changes = count_results(clients, nx, CHANGED_NXQL.format(path.replace("'", "\\'"), since))
+        except Exception as e:
+            logger.warning("Could not check collection {} for changes; refreshing it: {}".format(collection_id, e))
+            return collection_id, 'check failed'
 
-    feed_md = {}
+        return collection_id, '{} documents modified'.format(changes) if changes else None
 
-    url = "{}/api/v1/collection/?harvest_type=NUX&format=json".format(REGISTRY_BASE)
+    pool = ThreadPool(threads)
+    try:
+        return dict((collection_id, reason) for collection_id, reason in pool.map(check, feeds.items()) if reason)
+    finally:
+        pool.terminate()
+        registry.save_cache()
 
-    while True:
-        res = requests.get(url)
+def refresh_tracked(feeds, kwargs, state_filepath=None, changed_only=False, **options):
+    ''' refresh_collections, recording the time of each successful refresh in
+        the state file if given. With changed_only, collections that haven't
+        changed since their last refresh are skipped and reported as
+        UNCHANGED '''
+    state = load_state(state_filepath) if state_filepath else {}
+    started = time.time()
+
+    unchanged = []
+    if changed_only:
+        clients = kwargs['clients'] if 'clients' in kwargs else Clients()
+        changed = changed_collections(clients, feeds, state, kwargs)
+        for collection_id, reason in sorted(changed.items()):
+            logger.info("Collection {} needs refreshing: {}".format(collection_id, reason))
+        unchanged = [collection_id for collection_id in feeds if collection_id not in changed]
+        logger.info("{} of {} collections changed since last refresh".format(len(changed), len(feeds)))
+        feeds = dict((collection_id, feeds[collection_id]) for collection_id in changed)
+        kwargs = dict(kwargs, clients=clients)
+
+    statuses = refresh_collections(feeds, kwargs, **options)
+    for collection_id in unchanged:
+        statuses[collection_id] = {'collection_id': collection_id, 'status': 'UNCHANGED', 'entries': None, 'error': None, 'duration': None, 'summary': None}
+
+    if state_filepath:
+        # nothing changed before the checks ran, so the run start time also holds for unchanged collections
+        for collection_id, status in statuses.items():
+            if status['status'] in ('OK', 'UNCHANGED'):
+                state[collection_id] = {'refreshed': started}
+        save_state(state_filepath, state)
+
+    return statuses
+
+def count_results(clients, nx, query):
+    ''' get the number of documents matching an NXQL query, from the result count of a one-row search '''
+    url = u'{}/path/@search'.format(nx.conf['api'])
+    params = {'query': query, 'pageSize': 1}
+
+    def search():
+        res = clients.session.get(url, params=params, auth=(nx.conf['user'], nx.conf['password']))
         res.raise_for_status()
-        md = json.loads(res.content)
+        return json.loads(res.content)
 
-        for collection in md['objects']:
-            if collection['merritt_extra_data'] and collection['merritt_id']:
-                collection_id = collection['resource_uri'].split('/')[-2]
-                feed_md[collection_id] = {'nuxeo_endpoint': collection['merritt_extra_data'], 'merritt_id': collection['merritt_id']}
+    return clients.nuxeo_retry.call(search)['resultsCount']
 
+def count_documents(clients, nx, path):
+    ''' get the number of documents under a Nuxeo path '''
+    return count_results(clients, nx, COUNT_NXQL.format(path.replace("'", "\\'")))
 
-        next = md['meta']['next']
-        if not next:
-            break
+def estimate_sizes(clients, feeds, pynuxrc=None, threads=8):
+    ''' estimate the size of each collection by the number of documents under its Nuxeo path '''
+    nx = clients.nuxeo(pynuxrc)
 
-        url = "{}{}".format(REGISTRY_BASE, next)
- 
-    return feed_md
+    def estimate(item):
+        collection_id, value = item
+        if not value.get('nuxeo_endpoint'):
+            return collection_id, 0
+        try:
+            return collection_id, count_documents(clients, nx, value['nuxeo_endpoint'])
+        except Exception as e:
+            logger.warning("Could not estimate size of collection {}: {}".format(collection_id, e))
+            return collection_id, 0
+
+    pool = ThreadPool(threads)
+    try:
+        return dict(pool.map(estimate, feeds.items()))
+    finally:
+        pool.terminate()
+
+def init_worker():
+    ''' set up clients for a pool worker process, to be reused for each collection it refreshes '''
+    global worker_clients
+    worker_clients = Clients()
 
-def refresh_existing(kwargs):
+def refresh_collection(args):
+    ''' create and stash new feed for one collection. Returns a status dict for the report '''
+    collection_id, value, kwargs = args
+    if 'clients' not in kwargs and worker_clients:
+        kwargs = dict(kwargs, clients=worker_clients)
+    status = {'collection_id': collection_id, 'status': None, 'entries': None, 'error': None, 'summary': None}
+    started = time.time()
+    ma = None
+    try:
+        if value.get('merritt_id') and value.get('nuxeo_endpoint'):
+            ma = MerrittAtom(collection_id, merritt_id=value['merritt_id'], nuxeo_path=value['nuxeo_endpoint'], **kwargs)
+        else:
+            ma = MerrittAtom(collection_id, **kwargs)
+        status['status'] = ma.process_feed()
+        status['entries'] = ma.entry_count
+    except Exception as e:
+        logger.exception("Failed to refresh feed for collection {}".format(collection_id))
+        status['status'] = 'ERROR'
+        status['error'] = '{}: {}'.format(type(e).__name__, e)
+    status['duration'] = round(time.time() - started, 1)
+    if ma is not None:
+        status['summary'] = ma.summary
+
+    return status
+
+def refresh_collections(feeds, kwargs, processes=1, time_budget=None):
+    ''' refresh feeds for collections, given a dict of collection id -> registry info.
+        With more than one process, collections are estimated up front and the
+        biggest are scheduled first, so small collections don't queue behind
+        them at the end of the run. Collections not finished within
+        time_budget seconds are reported as TIMEOUT. Shared clients can be
+        passed in kwargs; worker processes always set up their own. Returns a
+        dict of collection id -> status dict '''
+    collection_ids = sorted(feeds.keys())
+    clients = kwargs['clients'] if 'clients' in kwargs else Clients()
+    if processes > 1:
+        sizes = estimate_sizes(clients, feeds, kwargs.get('pynuxrc'))
+        collection_ids.sort(key=lambda collection_id: sizes[collection_id], reverse=True)
+
+    deadline = time.time() + time_budget if time_budget else None
+    statuses = {}
+
+    if processes <= 1:
+        for collection_id in collection_ids:
+            if deadline and time.time() > deadline:
+                break
+            statuses[collection_id] = refresh_collection((collection_id, feeds[collection_id], dict(kwargs, clients=clients)))
+    else:
+        # clients can't be pickled, so each worker process sets up its own
+        kwargs = dict((k, v) for k, v in kwargs.items() if k != 'clients')
+        pool = multiprocessing.Pool(processes, initializer=init_worker)
+        results = [(collection_id, pool.apply_async(refresh_collection, ((collection_id, feeds[collection_id], kwargs),)))
+                   for collection_id in collection_ids]
+        pool.close()
+        try:
+            for collection_id, result in results:
+                timeout = max(deadline - time.time(), 0) if deadline else None
+                statuses[collection_id] = result.get(timeout)
+        except multiprocessing.TimeoutError:
+            logger.warning("Time budget of {} seconds used up; stopping refresh".format(time_budget))
+            pool.terminate()
+        pool.join()
+
+    for collection_id in collection_ids:
+        if collection_id not in statuses:
+            statuses[collection_id] = {'collection_id': collection_id, 'status': 'TIMEOUT', 'entries': None, 'error': None, 'duration': None, 'summary': None}
+
+    return statuses
+
+def aggregate_summaries(statuses):
+    ''' add up the per collection feed summaries for a run: time per phase, counters and S3 calls '''
+    totals = {'collections': dict(collections.Counter(v['status'] for v in statuses.values())),
+              'seconds': collections.Counter(), 'counters': collections.Counter(), 's3': {}}
+    for v in statuses.values():
+        summary = v.get('summary')
+        if not summary:
+            continue
+        totals['seconds'].update(summary['seconds'])
+        totals['counters'].update(summary['counters'])
+        for name, s3 in summary['s3'].items():
+            total = totals['s3'].setdefault(name, {'calls': 0, 'seconds': 0})
+            total['calls'] = total['calls'] + s3['calls']
+            total['seconds'] = total['seconds'] + s3['seconds']
+
+    totals['seconds'] = dict((name, round(seconds, 3)) for name, seconds in totals['seconds'].items())
+    totals['counters'] = dict(totals['counters'])
+    for total in totals['s3'].values():
+        total['seconds'] = round(total['seconds'], 3)
+
+    return totals
+
+def report_statuses(statuses, report_filepath=None):
+    ''' log feed status for each collection and totals for the run, and
+        optionally write them to a JSON report '''
+    for k, v in sorted(statuses.items()):
+        logger.info('Feed status for collection {}: {} ({} entries, {}s){}'.format(
+            k, v['status'], v['entries'], v['duration'], ' {}'.format(v['error']) if v['error'] else ''))
+
+    totals = aggregate_summaries(statuses)
+    logger.info('Run summary: {}'.format(json.dumps(totals)))
+
+    if report_filepath:
+        with open(report_filepath, 'w') as f:
+            json.dump({'collections': [statuses[k] for k in sorted(statuses)], 'summary': totals}, f, indent=2)
+
+def refresh_existing(kwargs, state_filepath=None, changed_only=False):
     ''' refresh feeds already on s3 '''
 
     # get a list of current feeds on S3
@@ -84,21 +317,18 @@ def refresh_existing(kwargs):
 
     bucket = s3.Bucket(bucketbase)
 
-    statuses = {}
+    feeds = {}
     for obj in bucket.objects.filter(Prefix=prefix):
-        if obj.key.endswith('.atom'):
-            # get collection ID for each existing ATOM file
-            filename = obj.key.split(prefix)[1]
-            basename = filename.split('.')[0]
-            collection_id = basename.split('_')[-1]
+        # get collection ID for each existing ATOM file
+        match = FEED_KEY_RE.match(obj.key.split(prefix)[1])
+        if match:
+            collection_id = match.group(1)
             logger.info("collection_id: {}".format(collection_id))
+            feeds[collection_id] = {}
 
-            # create and stash new feed for each
-            ma = MerrittAtom(collection_id, **kwargs)
-            statuses['collection_id']  = ma.process_feed()
-
-    for k, v in statuses.items():
-        logger.info('Feed status for collection {}: {}'.format(k, v))
+    # create and stash new feed for each
+    statuses = refresh_tracked(feeds, kwargs, state_filepath, changed_only)
+    report_statuses(statuses)
 
 if __name__ == "__main__":
     sys.exit(main())
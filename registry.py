@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import logging
+import threading
+import tempfile
+import requests
+from resilience import RetryPolicy
+from multiprocessing.pool import ThreadPool
+from os.path import expanduser
+
+""" Client for the UCLDC collection registry API, shared by MerrittAtom and the feed scripts. """
+REGISTRY_BASE = 'https://registry.cdlib.org/'
+REGISTRY_API_BASE = '{}api/v1/'.format(REGISTRY_BASE)
+PAGE_SIZE = 100
+CACHE_TTL = 3600
+CACHE_FILENAME = 'registry_cache.json'
+
+class RegistryClient():
+    ''' Fetches collection records from the registry. Each record is fetched at
+        most once per client, list pages are fetched concurrently, and if
+        cache_dir is given responses are also kept on disk for ttl seconds
+        so that repeated runs skip the registry entirely. Failed requests are
+        retried according to retry. '''
+
+    def __init__(self, cache_dir=None, ttl=CACHE_TTL, session=None, threads=4, api_base=REGISTRY_API_BASE, retry=None):
+        self.logger = logging.getLogger(__name__)
+        self.api_base = api_base
+        self.ttl = ttl
+        self.threads = threads
+        self.session = session if session else requests.Session()
+        self.retry = retry if retry else RetryPolicy()
+
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._unsaved = False
+        self._cache_filepath = None
+        if cache_dir:
+            self._cache_filepath = os.path.join(expanduser(cache_dir), CACHE_FILENAME)
+            self._load_cache()
+
+    def _load_cache(self):
+        ''' load unexpired responses from the on-disk cache '''
+        try:
+            with open(self._cache_filepath, 'r') as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            return
+
+        now = time.time()
+        self._cache = dict((url, value) for url, value in cached.items() if now - value['fetched'] < self.ttl)
+
+    def save_cache(self):
+        ''' write cached responses to disk, if anything was fetched since they
+            were last written. Safe to call from several threads '''
+        if not self._cache_filepath:
+            return
+
+        cache_dir = os.path.dirname(self._cache_filepath)
+        with self._lock:
+            if not self._unsaved:
+                return
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+
+            fd, tmp_filepath = tempfile.mkstemp(prefix='{}.'.format(CACHE_FILENAME), suffix='.tmp', dir=cache_dir)
+            try:
+                with os.fdopen(fd, 'w') as f:
+                    json.dump(self._cache, f)
+                os.rename(tmp_filepath, self._cache_filepath)
+            except Exception:
+                os.remove(tmp_filepath)
+                raise
+            self._unsaved = False
+
+    def _get_json(self, url):
+        ''' GET registry url and return parsed JSON, going through the cache '''
+        # expired entries were dropped when the disk cache was loaded
+        with self._lock:
+            cached = self._cache.get(url)
+        if cached:
+            return cached['data']
+
+        md = self.retry.call(self._fetch_json, url)
+
+        with self._lock:
+            self._cache[url] = {'fetched': time.time(), 'data': md}
+            self._unsaved = True
+
+        return md
+
+    def _fetch_json(self, url):
+        res = self.session.get(url)
+        res.raise_for_status()
+        return json.loads(res.content)
+
+    def _collection_url(self, collection_id):
+        return "{}collection/{}/?format=json".format(self.api_base, collection_id)
+
+    def _list_url(self, offset, limit=PAGE_SIZE):
+        return "{}collection/?harvest_type=NUX&format=json&limit={}&offset={}".format(self.api_base, limit, offset)
+
+    def get_collection(self, collection_id, save=True):
+        ''' get registry record for a single collection. When looking up a
+            batch of collections, pass save=False and call save_cache once
+            at the end '''
+        md = self._get_json(self._collection_url(collection_id))
+        if save:
+            self.save_cache()
+
+        return md
+
+    def get_collections(self):
+        ''' get registry records for all Nuxeo collections. The first page gives
+            the total count; the remaining pages are then fetched concurrently '''
+        first_page = self._get_json(self._list_url(0))
+        total = first_page['meta']['total_count']
+        limit = first_page['meta']['limit'] or PAGE_SIZE
+
+        pages = [first_page]
+        offsets = range(limit, total, limit)
+        if offsets:
+            pool = ThreadPool(self.threads)
+            try:
+                pages.extend(pool.map(lambda offset: self._get_json(self._list_url(offset, limit)), offsets))
+            finally:
+                pool.terminate()
+
+        collections = []
+        for page in pages:
+            for collection in page['objects']:
+                collections.append(collection)
+                # list records are the same as the single collection records
+                with self._lock:
+                    self._cache.setdefault(self._collection_url(collection_id_from_record(collection)),
+                                           {'fetched': time.time(), 'data': collection})
+        self.save_cache()
+
+        return collections
+
+    def get_feed_info(self):
+        ''' get list of collections for which to create feeds, based on registry info '''
+        feed_md = {}
+        for collection in self.get_collections():
+            info = feed_info_from_record(collection)
+            if info:
+                feed_md[collection_id_from_record(collection)] = info
+
+        return feed_md
+
+def collection_id_from_record(collection):
+    ''' registry collection ID from a collection record '''
+    return collection['resource_uri'].split('/')[-2]
+
+def feed_info_from_record(collection):
+    ''' merritt id and nuxeo endpoint for a collection record, or None if it doesn't get a feed '''
+    if collection['merritt_extra_data'] and collection['merritt_id']:
+        return {'nuxeo_endpoint': collection['merritt_extra_data'], 'merritt_id': collection['merritt_id']}
+
+    return None
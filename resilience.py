@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import random
+import logging
+import threading
+import calendar
+from email.utils import parsedate_tz, mktime_tz
+from contextlib import contextmanager
+import requests
+
+""" Retries with backoff, and an adaptive limit on concurrent requests, shared by the Nuxeo, registry and plain HTTP calls. """
+RETRY_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 60.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# the most requests to Nuxeo to have in flight when it's healthy
+MAX_CONCURRENCY = 64
+# requests taking this many times longer than usual are a sign of overload
+LATENCY_FACTOR = 3.0
+# wait this long after cutting the limit before cutting it again
+BACKOFF_COOLDOWN = 5.0
+
+logger = logging.getLogger(__name__)
+
+def is_transient(error):
+    ''' check whether a failed request is worth trying again '''
+    if isinstance(error, requests.HTTPError):
+        return error.response is not None and error.response.status_code in RETRY_STATUSES
+
+    return isinstance(error, (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError))
+
+def retry_after(error):
+    ''' seconds to wait according to the Retry-After header of a failed response, or None '''
+    response = getattr(error, 'response', None)
+    value = response.headers.get('Retry-After') if response is not None else None
+    if not value:
+        return None
+
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+
+    # or an HTTP date
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(mktime_tz(parsed) - calendar.timegm(time.gmtime()), 0)
+
+class AdaptiveLimiter():
+    ''' Caps the number of requests in flight, whichever thread makes them.
+        The limit is halved when a request fails with a transient error or
+        takes much longer than usual, at most once per cooldown, and grows
+        back by one for every limit requests that succeed in good time.
+        Only single requests should take a slot; see RetryPolicy.call_listing. '''
+
+    def __init__(self, maximum=MAX_CONCURRENCY, minimum=1, latency_factor=LATENCY_FACTOR, cooldown=BACKOFF_COOLDOWN):
+        self.maximum = maximum
+        self.minimum = minimum
+        self.latency_factor = latency_factor
+        self.cooldown = cooldown
+        self.limit = float(maximum)
+        self.decreases = 0
+
+        self._in_flight = 0
+        # running averages of request latency: long term and recent
+        self._usual = None
+        self._recent = None
+        self._decreased = 0
+        self._condition = threading.Condition()
+
+    @contextmanager
+    def slot(self):
+        ''' wait for room under the limit, then run the request in the with block '''
+        with self._condition:
+            while self._in_flight >= int(self.limit):
+                self._condition.wait()
+            self._in_flight = self._in_flight + 1
+
+        started = time.time()
+        try:
+            yield
+        except Exception as e:
+            self._release(time.time() - started, not is_transient(e))
+            raise
+        self._release(time.time() - started, True)
+
+    def _release(self, latency, ok):
+        with self._condition:
+            self._in_flight = self._in_flight - 1
+            self._update(latency, ok)
+            self._condition.notify_all()
+
+    def failed(self):
+        ''' count a transient failure of a request made without a slot '''
+        with self._condition:
+            self._update(None, False)
+
+    def _update(self, latency, ok):
+        ''' adjust the limit for how a request went. Called holding the condition '''
+        overloaded = not ok
+        if ok:
+            if self._usual is None:
+                self._usual = self._recent = latency
+            else:
+                self._usual = self._usual * 0.98 + latency * 0.02
+                self._recent = self._recent * 0.8 + latency * 0.2
+            overloaded = self._recent > self._usual * self.latency_factor
+
+        now = time.time()
+        if overloaded:
+            if now - self._decreased >= self.cooldown and self.limit > self.minimum:
+                self.limit = max(self.limit / 2, self.minimum)
+                self._decreased = now
+                self.decreases = self.decreases + 1
+                logger.warning("Requests failing or slowing down; limiting to {} at a time".format(int(self.limit)))
+        elif self.limit < self.maximum:
+            self.limit = min(self.limit + 1 / self.limit, self.maximum)
+
+    def stats(self):
+        with self._condition:
+            return {'limit': int(self.limit), 'in_flight': self._in_flight, 'decreases': self.decreases}
+
+class RetryPolicy():
+    ''' Runs a request, retrying it on connection errors, timeouts and 429/5xx
+        responses with jittered exponential backoff, or after as long as the
+        server's Retry-After asks. Requests go through limiter, if given, with
+        the waits between attempts outside of it. '''
+
+    def __init__(self, attempts=RETRY_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY, limiter=None):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.limiter = limiter
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def call(self, function, *args, **kwargs):
+        ''' function(*args, **kwargs), retried as need be. The last error is raised once attempts run out '''
+        return self._call(True, function, args, kwargs)
+
+    def call_listing(self, function, *args, **kwargs):
+        ''' as call, for a listing made of many requests one after another,
+            e.g. all the documents of a collection. A listing runs outside the
+            limiter: it would hold a slot for its whole length, and how long
+            it takes says nothing about how long a request takes. Its
+            transient failures still count against the limit '''
+        return self._call(False, function, args, kwargs)
+
+    def _call(self, limited, function, args, kwargs):
+        attempt = 0
+        while True:
+            attempt = attempt + 1
+            try:
+                if self.limiter and limited:
+                    with self.limiter.slot():
+                        return function(*args, **kwargs)
+                return function(*args, **kwargs)
+            except Exception as e:
+                if self.limiter and not limited and is_transient(e):
+                    self.limiter.failed()
+                if attempt >= self.attempts or not is_transient(e):
+                    raise
+                delay = self.delay(attempt, e)
+                with self._lock:
+                    self.retries = self.retries + 1
+                logger.warning("Request failed ({}); retrying in {:.1f}s, attempt {} of {}".format(e, delay, attempt + 1, self.attempts))
+                time.sleep(delay)
+
+    def delay(self, attempt, error):
+        ''' seconds to wait before the next attempt '''
+        requested = retry_after(error)
+        if requested is not None:
+            return min(requested, self.max_delay)
+
+        return random.uniform(0, min(self.base_delay * 2 ** (attempt - 1), self.max_delay))
+
+    def stats(self):
+        stats = {'retries': self.retries}
+        if self.limiter:
+            stats.update(self.limiter.stats())
+        return stats
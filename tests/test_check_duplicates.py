@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+import unittest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'check_duplicates.py')
+
+FEED = '''<?xml version='1.0' encoding='utf-8'?>
+<feed xmlns="http://www.w3.org/2005/Atom" xmlns:dc="http://purl.org/dc/elements/1.1/">
+  <entry>
+    <link rel="alternate" href="https://nuxeo.example.org/Nuxeo/site/api/v1/id/object.xml" type="application/xml"/>
+    <link rel="alternate" href="https://nuxeo.example.org/Nuxeo/site/api/v1/id/page-1.xml" type="application/xml"/>
+    <dc:identifier>object</dc:identifier>
+  </entry>
+  <entry>
+    <link rel="alternate" href="https://nuxeo.example.org/Nuxeo/site/api/v1/id/page-1.xml" type="application/xml"/>
+    <dc:identifier>other</dc:identifier>
+  </entry>
+  <entry>
+    <dc:identifier>object</dc:identifier>
+  </entry>
+  <entry>
+    <dc:identifier>page-1</dc:identifier>
+  </entry>
+</feed>
+'''
+
+class CheckDuplicatesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filepath = os.path.join(self.dir, 'feed.atom')
+        with open(self.filepath, 'w') as f:
+            f.write(FEED)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_duplicates(self):
+        ''' an object with two entries, a component in two entries and a component with its own entry '''
+        output = subprocess.check_output([sys.executable, SCRIPT, self.filepath])
+        count, dup_parents, dup_components = output.splitlines()[-3:]
+        self.assertEqual((count, dup_parents, dup_components), ('4', '1', '2'))
+        self.assertIn("['object']", output)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,631 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import argparse
+import json
+import gzip
+import hashlib
+import shutil
+import tempfile
+import unittest
+from io import BytesIO
+from operator import itemgetter
+from datetime import datetime, timedelta
+import dateutil.tz
+from lxml import etree
+from dateutil.parser import parse
+from botocore.exceptions import ClientError
+import merritt_atom
+from merritt_atom import MerrittAtom, MetadataCache, EntryIds, add_feed_arguments, feed_kwargs, BUCKET, MEDIA_JSON_BUCKET, MEDIA_JSON_REGION
+from clients import Clients
+
+API = 'https://nuxeo.example.org/Nuxeo/site/api/v1'
+COLLECTION_PATH = '/asset-library/UCX/test'
+
+def nuxeo_doc(uid, path, doc_type='SampleCustomPicture', title=None, modified='2016-01-01T00:00:00.00Z'):
+    return {'uid': uid, 'path': path, 'type': doc_type, 'title': title or uid,
+            'lastModified': modified,
+            'properties': {'file:content': {'name': '{}.tif'.format(uid), 'digest': 'digest-{}'.format(uid),
+                                            'data': '{}/nxfile/default/{}/file:content/{}.tif'.format(API, uid, uid)},
+                           'files:files': [], 'extra_files:file': [],
+                           'ucldc_schema:creator': [], 'ucldc_schema:date': [],
+                           'ucldc_schema:identifier': None, 'ucldc_schema:collection': []}}
+
+def collection_docs(count, components=0):
+    ''' docs for a collection of count objects, modified a day apart, each with a number of components '''
+    docs = [nuxeo_doc('collection', COLLECTION_PATH, doc_type='Organization')]
+    for i in range(count):
+        uid = 'object-{:03d}'.format(i)
+        modified = (datetime(2016, 1, 1) + timedelta(days=i)).strftime('%Y-%m-%dT%H:%M:%S.00Z')
+        docs.append(nuxeo_doc(uid, '{}/{}'.format(COLLECTION_PATH, uid), modified=modified))
+        for j in range(components):
+            component_uid = '{}-page-{}'.format(uid, j)
+            docs.append(nuxeo_doc(component_uid, '{}/{}/{}'.format(COLLECTION_PATH, uid, component_uid), modified=modified))
+    return docs
+
+class FakeNuxeo():
+    ''' enough of pynux's Nuxeo client to run NXQL path searches against a fixed set of docs '''
+
+    def __init__(self, docs):
+        self.conf = {'api': API}
+        self.docs = docs
+        self.queries = []
+        # searches under these paths fail
+        self.failing = set()
+
+    def nxql(self, query):
+        self.queries.append(query)
+        types = [t.strip() for t in re.search(r"FROM (.+?) WHERE", query).group(1).split(',')]
+        path = re.search(r"ecm:path STARTSWITH '([^']*)'", query).group(1)
+        if path in self.failing:
+            raise ValueError("search failed: {}".format(path))
+        since = re.search(r"dc:modified >= TIMESTAMP '([^']*)'", query)
+        docs = self.docs
+        if 'ORDER BY ecm:uuid' in query:
+            docs = sorted(docs, key=itemgetter('uid'))
+        for doc in docs:
+            # STARTSWITH matches documents under the path, not the one at it
+            if not doc['path'].startswith(path + '/'):
+                continue
+            if 'Document' not in types and doc['type'] not in types:
+                continue
+            if since and parse(doc['lastModified']) < parse(since.group(1)):
+                continue
+            yield doc
+
+    def get_metadata(self, uid=None, path=None):
+        return [doc for doc in self.docs if doc['uid'] == uid or doc['path'] == path][0]
+
+    def modify(self, uid, modified):
+        ''' change when a doc was last modified '''
+        [doc for doc in self.docs if doc['uid'] == uid][0]['lastModified'] = modified
+
+class FakeDeepHarvest():
+    ''' stands in for DeepHarvestNuxeo, listing the objects directly under the collection '''
+
+    def __init__(self, nx, path):
+        self.nx = nx
+        self.path = path
+
+    def fetch_objects(self):
+        return [dict(doc) for doc in self.nx.docs
+                if doc['path'].rsplit('/', 1)[0] == self.path and doc['type'] != 'Organization']
+
+class FakeFetcher():
+    ''' stands in for NuxeoFetcher, searching FakeNuxeo '''
+
+    def __init__(self, nx):
+        self.nx = nx
+        self.requests = 0
+
+    def search(self, query):
+        return list(self.nx.nxql(query))
+
+    def close(self):
+        pass
+
+class FakeS3():
+    ''' S3 client holding objects in a dict of (bucket, key) -> object, with
+        its Body, Metadata, ContentEncoding and LastModified '''
+
+    def __init__(self):
+        self.objects = {}
+        self.puts = []
+        self.deletes = []
+
+    def add(self, Bucket, Key, Body=b'', Metadata=None, ContentEncoding=None, LastModified=None):
+        self.objects[(Bucket, Key)] = {'Body': Body, 'Metadata': Metadata or {},
+                                       'ContentEncoding': ContentEncoding,
+                                       'LastModified': LastModified or datetime.now(dateutil.tz.tzutc())}
+
+    def _get(self, Bucket, Key, operation):
+        if (Bucket, Key) not in self.objects:
+            raise ClientError({'Error': {'Code': '404', 'Message': 'Not Found'}}, operation)
+        return self.objects[(Bucket, Key)]
+
+    def head_object(self, Bucket, Key):
+        obj = self._get(Bucket, Key, 'HeadObject')
+        return dict((name, value) for name, value in obj.items() if name != 'Body' and value is not None)
+
+    def get_object(self, Bucket, Key):
+        obj = self._get(Bucket, Key, 'GetObject')
+        response = self.head_object(Bucket, Key)
+        response['Body'] = BytesIO(obj['Body'])
+        return response
+
+    def put_object(self, Bucket, Key, Body=b'', **kwargs):
+        self.puts.append((Bucket, Key))
+        self.add(Bucket, Key, Body, **kwargs)
+
+    def upload_fileobj(self, f, Bucket, Key, ExtraArgs=None):
+        self.put_object(Bucket, Key, f.read(), **(ExtraArgs or {}))
+
+    def delete_object(self, Bucket, Key):
+        self.deletes.append((Bucket, Key))
+        self.objects.pop((Bucket, Key), None)
+
+    def contents(self, Bucket, Key):
+        ''' body of an object, gunzipped if need be '''
+        obj = self._get(Bucket, Key, 'GetObject')
+        if obj['ContentEncoding'] == 'gzip':
+            return gzip.GzipFile(fileobj=BytesIO(obj['Body'])).read()
+        return obj['Body']
+
+class RecordingStashMediaJson():
+    ''' stands in for NuxeoStashMediaJson, recording the objects it's asked to stash media.json for '''
+    stashed = []
+
+    def __init__(self, path, bucket, region):
+        self.args = (path, bucket, region)
+
+    def nxstashref(self):
+        RecordingStashMediaJson.stashed.append(self.args)
+
+class FakeClients(Clients):
+
+    def __init__(self, nx):
+        Clients.__init__(self)
+        self.nx = nx
+        self.fake_s3 = FakeS3()
+
+    def nuxeo(self, pynuxrc=None):
+        return self.nx
+
+    def s3(self, region_name=None):
+        return self.fake_s3
+
+class FeedTestCase(unittest.TestCase):
+    ''' runs MerrittAtom for a collection in FakeNuxeo, stashing to FakeS3,
+        without the registry or deepharvest '''
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.nx = FakeNuxeo(self.collection())
+        self.clients = FakeClients(self.nx)
+        self.s3 = self.clients.fake_s3
+
+        self._patched = {}
+        self.patch('DeepHarvestNuxeo', lambda path, bucket, pynuxrc=None: FakeDeepHarvest(self.nx, path))
+        self.patch('NuxeoFetcher', lambda conf, concurrency, connections=None, **kwargs: FakeFetcher(self.nx))
+        self.patch('NuxeoStashMediaJson', RecordingStashMediaJson)
+        RecordingStashMediaJson.stashed = []
+
+    def tearDown(self):
+        for name, value in self._patched.items():
+            setattr(merritt_atom, name, value)
+        shutil.rmtree(self.dir)
+
+    def patch(self, name, value):
+        self._patched[name] = getattr(merritt_atom, name)
+        setattr(merritt_atom, name, value)
+
+    def collection(self):
+        return collection_docs(5)
+
+    def merritt_atom(self, **kwargs):
+        return MerrittAtom('123', merritt_id='ark:/13030/m5test', nuxeo_path=COLLECTION_PATH, pynuxrc='test-pynuxrc',
+                           dir=self.dir, clients=self.clients, registry=None, **kwargs)
+
+    def process_feed(self, **kwargs):
+        ma = self.merritt_atom(**kwargs)
+        self.assertEqual(ma.process_feed(), 'OK')
+        return ma
+
+    def published(self, filename='ucldc_collection_123.atom'):
+        ''' contents of a file stashed to the feed bucket '''
+        bucket, key = BUCKET.split('/', 1)
+        return self.s3.contents(bucket, '{}/{}'.format(key, filename))
+
+    def entry_ids(self, feed):
+        return re.findall(r'<dc:identifier>([^<]*)</dc:identifier>', feed)
+
+    def without_updated(self, feed):
+        ''' a feed without its own <updated>, which changes on every run '''
+        return re.sub(r'<updated>[^<]*</updated>', '', feed, count=1)
+
+class FetchComponentsTestCase(FeedTestCase):
+
+    def setUp(self):
+        FeedTestCase.setUp(self)
+        self.ma = self.merritt_atom()
+        self.doc = dict(self.nx.docs[0], bundle_lastModified=datetime(2016, 1, 1, tzinfo=dateutil.tz.tzutc()))
+
+    def collection(self):
+        return [nuxeo_doc('object', '/asset-library/UCX/test/object'),
+                nuxeo_doc('page-1', '/asset-library/UCX/test/object/page-1'),
+                nuxeo_doc('folder', '/asset-library/UCX/test/object/folder', doc_type='Organization'),
+                nuxeo_doc('page-2', '/asset-library/UCX/test/object/folder/page-2', doc_type='CustomFile'),
+                nuxeo_doc('other', '/asset-library/UCX/test/other')]
+
+    def test_nested_components(self):
+        ''' components inside a folder under the object are included, the folder itself isn't '''
+        components = self.ma._fetch_components(self.doc)
+        self.assertEqual([c['uid'] for c in components], ['page-1', 'page-2'])
+        self.assertEqual(len(self.nx.queries), 1)
+
+    def test_nested_components_in_entry(self):
+        entry = self.ma._construct_entry_bundled(self.doc)
+        links = [link.get('href') for link in entry.iter('{http://www.w3.org/2005/Atom}link')]
+        self.assertTrue(any('/page-2/' in href for href in links))
+        self.assertFalse(any('/folder/' in href for href in links))
+
+class MediaJsonTestCase(FeedTestCase):
+
+    def setUp(self):
+        FeedTestCase.setUp(self)
+        self.ma = self.merritt_atom()
+        self.doc = dict(self.nx.docs[0], bundle_lastModified=datetime(2016, 1, 1, tzinfo=dateutil.tz.tzutc()))
+
+    def collection(self):
+        return [nuxeo_doc('object', '/asset-library/UCX/test/object'),
+                nuxeo_doc('page-1', '/asset-library/UCX/test/object/page-1')]
+
+    def stash(self, build):
+        ''' media.json stashed for the doc when its entry is built or reused '''
+        self.ma._start_media_json_stash()
+        if build:
+            self.ma._build_entry(self.doc)
+        else:
+            self.ma._queue_media_json(self.doc)
+        self.ma._finish_media_json_stash()
+        return RecordingStashMediaJson.stashed
+
+    def test_media_json_stashed_once_by_library(self):
+        ''' media.json is stashed once per object by NuxeoStashMediaJson, whether its entry is built or reused '''
+        for build in (True, False):
+            RecordingStashMediaJson.stashed = []
+            self.assertEqual(self.stash(build), [(self.doc['path'], MEDIA_JSON_BUCKET, MEDIA_JSON_REGION)])
+
+        # nothing else writes media.json
+        self.assertEqual(self.s3.puts, [])
+
+    def test_current_media_json_not_stashed(self):
+        bucket, key = self.ma._s3_location(MEDIA_JSON_BUCKET, self.ma.get_media_json_filename(self.doc['uid']))
+        self.s3.add(bucket, key, LastModified=self.doc['bundle_lastModified'] + timedelta(days=1))
+
+        self.assertEqual(self.stash(build=True), [])
+        self.assertEqual(self.ma.media_json_failures, {})
+
+class PagedFeedTestCase(FeedTestCase):
+    ''' feeds split into a head page and archive pages of up to page_size entries '''
+
+    def setUp(self):
+        FeedTestCase.setUp(self)
+        self.ids = ['object-{:03d}'.format(i) for i in range(25)]
+
+    def collection(self):
+        return collection_docs(25)
+
+    def manifest(self):
+        return json.loads(self.published('ucldc_collection_123.pages.json'))
+
+    def pages(self):
+        ''' entry ids of each archive page, oldest page first, then of the head page '''
+        pages = [self.published(page['filename']) for page in self.manifest()['pages']]
+        return [self.entry_ids(page) for page in pages + [self.published()]]
+
+    def links(self, feed):
+        root = etree.fromstring(feed)
+        return dict((link.get('rel'), link.get('href')) for link in root.iterchildren('{http://www.w3.org/2005/Atom}link'))
+
+    def archive_keys(self):
+        return sorted(key for bucket, key in self.s3.objects if re.search(r'_123_\d+_\d+\.atom$', key))
+
+    def test_pages(self):
+        ma = self.process_feed(page_size=10)
+
+        # oldest entries on the first archive page, newest first on each page
+        self.assertEqual(self.pages(), [self.ids[9::-1], self.ids[19:9:-1], self.ids[:19:-1]])
+
+        first, second = ['{}{}'.format(ma.feed_base_url, page['filename']) for page in self.manifest()['pages']]
+        head = self.links(self.published())
+        self.assertEqual((head['prev-archive'], head['last']), (second, first))
+        links = self.links(self.published(self.manifest()['pages'][1]['filename']))
+        self.assertEqual((links['self'], links['prev-archive'], links['next-archive']), (second, first, ma.s3_url))
+        self.assertNotIn('fh:archive', self.published())
+        self.assertIn('<fh:archive/>', self.published(self.manifest()['pages'][0]['filename']))
+
+    def test_changed_object_moves_to_head(self):
+        ''' only the archive page it was on is rewritten '''
+        self.process_feed(page_size=10)
+        first, second = self.archive_keys()
+        self.s3.puts = []
+
+        self.nx.modify('object-003', '2017-01-01T00:00:00.00Z')
+        self.process_feed(page_size=10, incremental=True)
+
+        pages = self.pages()
+        self.assertEqual(pages[0], self.ids[9:3:-1] + self.ids[2::-1])
+        self.assertEqual(pages[2], ['object-003'] + self.ids[:19:-1])
+        self.assertEqual(self.archive_keys(), [first, second])
+        uploaded = [key for bucket, key in self.s3.puts]
+        self.assertIn(first, uploaded)
+        self.assertNotIn(second, uploaded)
+
+    def test_rollover(self):
+        ''' once more than a quarter of the archive is out of date, new pages
+            are written and the old ones removed after the head is uploaded '''
+        self.process_feed(page_size=10)
+        for uid in self.ids[:6]:
+            self.nx.modify(uid, '2017-01-01T00:00:00.00Z')
+        self.process_feed(page_size=10, incremental=True)
+
+        pages = self.pages()
+        self.assertEqual(sorted(sum(pages, [])), self.ids)
+        self.assertEqual([len(page) for page in pages], [10, 10, 5])
+        self.assertEqual(self.archive_keys(), sorted('merritt/{}'.format(page['filename']) for page in self.manifest()['pages']))
+
+class FeedIndexTestCase(FeedTestCase):
+    ''' the sidecar index stashed with a feed, which incremental runs use
+        rather than scanning the published feed '''
+
+    def collection(self):
+        return collection_docs(5, components=2)
+
+    def index(self):
+        lines = self.published('ucldc_collection_123.index.jsonl').splitlines()
+        return json.loads(lines[0]), [json.loads(line) for line in lines[1:]]
+
+    def replace_index(self, header, records):
+        bucket, key = BUCKET.split('/', 1)
+        lines = [json.dumps(header)] + [json.dumps(record) for record in records]
+        self.s3.objects[(bucket, '{}/ucldc_collection_123.index.jsonl'.format(key))]['Body'] = '\n'.join(lines) + '\n'
+
+    def process_incremental(self):
+        ''' run incrementally, returning MerrittAtom and the feed files it scanned '''
+        ma = self.merritt_atom(incremental=True)
+        scanned = []
+        read_previous_feed = ma._read_previous_feed
+        def record_read(filepath):
+            scanned.append(filepath)
+            return read_previous_feed(filepath)
+        ma._read_previous_feed = record_read
+        self.assertEqual(ma.process_feed(), 'OK')
+        return ma, scanned
+
+    def test_index_records(self):
+        self.process_feed()
+        header, records = self.index()
+        feed = self.published()
+
+        bucket, key = BUCKET.split('/', 1)
+        feed_digest = self.s3.head_object(Bucket=bucket, Key='{}/ucldc_collection_123.atom'.format(key))['Metadata']['feed-digest']
+        self.assertEqual((header['entries'], header['digest']), (5, feed_digest))
+        self.assertEqual([record['id'] for record in records], self.entry_ids(feed))
+        for record in records:
+            fragment = feed[record['offset']:record['offset'] + record['length']]
+            self.assertEqual(self.entry_ids(fragment), [record['id']])
+            self.assertEqual(hashlib.sha256(fragment).hexdigest(), record['sha256'])
+            self.assertEqual(record['components'], ['{}-page-0'.format(record['id']), '{}-page-1'.format(record['id'])])
+
+    def test_incremental_uses_index(self):
+        self.process_feed()
+        feed = self.published()
+        # modified since the published feed's index was made
+        self.nx.modify('object-002-page-1', datetime.now(dateutil.tz.tzutc()).isoformat())
+        self.nx.queries = []
+
+        ma, scanned = self.process_incremental()
+
+        self.assertEqual(scanned, [])
+        self.assertEqual((ma.reused_entries, ma.summary['counters']['entries_built']), (4, 1))
+        # only the changed object's components were listed
+        self.assertEqual(len([query for query in self.nx.queries if 'FROM Document' not in query]), 1)
+        expected = self.entry_ids(feed)
+        expected.remove('object-002')
+        self.assertEqual(self.entry_ids(self.published()), ['object-002'] + expected)
+        self.assertFalse(os.path.exists(ma._get_previous_feed_filepath()))
+
+    def test_stale_index(self):
+        ''' an index that doesn't match the published feed is ignored, and the feed scanned instead '''
+        self.process_feed()
+        feed = self.published()
+        header, records = self.index()
+        header['digest'] = 'stale'
+        self.replace_index(header, records)
+
+        ma, scanned = self.process_incremental()
+
+        self.assertEqual(scanned, [ma._get_previous_feed_filepath()])
+        self.assertEqual(ma.reused_entries, 5)
+        self.assertEqual(self.without_updated(self.published()), self.without_updated(feed))
+
+    def test_mismatched_entry_rebuilt(self):
+        ''' an entry whose bytes don't match its index record is built again '''
+        self.process_feed()
+        feed = self.published()
+        header, records = self.index()
+        records[0]['sha256'] = 'mismatched'
+        self.replace_index(header, records)
+
+        ma, scanned = self.process_incremental()
+
+        self.assertEqual((ma.reused_entries, ma.summary['counters']['entries_built']), (4, 1))
+        self.assertEqual(self.without_updated(self.published()), self.without_updated(feed))
+
+    def test_paged_feed_has_no_index(self):
+        self.process_feed(page_size=2)
+        self.assertRaises(ClientError, self.published, 'ucldc_collection_123.index.jsonl')
+
+class StashTestCase(FeedTestCase):
+    ''' stashing the feed on s3, only when its content has changed '''
+
+    def setUp(self):
+        FeedTestCase.setUp(self)
+        bucket, key = BUCKET.split('/', 1)
+        self.feed_location = (bucket, '{}/ucldc_collection_123.atom'.format(key))
+
+    def uploaded(self, **kwargs):
+        ''' run, returning whether the feed was uploaded '''
+        self.s3.puts = []
+        self.process_feed(**kwargs)
+        return self.feed_location in self.s3.puts
+
+    def test_unchanged_feed_not_uploaded(self):
+        self.assertTrue(self.uploaded())
+        self.assertFalse(self.uploaded())
+
+        self.nx.modify('object-001', '2017-01-01T00:00:00.00Z')
+        self.assertTrue(self.uploaded())
+
+    def test_gzip(self):
+        self.assertTrue(self.uploaded(gzip=True))
+        stashed = self.s3.objects[self.feed_location]
+        self.assertEqual(stashed['ContentEncoding'], 'gzip')
+        with open(os.path.join(self.dir, 'ucldc_collection_123.atom'), 'rb') as f:
+            self.assertEqual(gzip.GzipFile(fileobj=BytesIO(stashed['Body'])).read(), f.read())
+        # the gzipped copy is removed once uploaded
+        self.assertEqual(sorted(os.listdir(self.dir)), ['ucldc_collection_123.atom', 'ucldc_collection_123.index.jsonl'])
+
+        self.assertFalse(self.uploaded(gzip=True))
+        # same content, but no longer gzipped
+        self.assertTrue(self.uploaded())
+        self.assertNotIn('ContentEncoding', self.s3.head_object(*self.feed_location))
+
+    def test_incremental_from_gzipped_feed(self):
+        self.process_feed(gzip=True)
+        ma = self.process_feed(gzip=True, incremental=True)
+        self.assertEqual(ma.reused_entries, 5)
+
+class CheckpointTestCase(FeedTestCase):
+    ''' resuming a run that failed part way from its checkpoint '''
+
+    def setUp(self):
+        FeedTestCase.setUp(self)
+        self.checkpoint_filepath = os.path.join(self.dir, 'ucldc_collection_123.checkpoint')
+
+    def fail_at(self, uid):
+        ''' run until building the entry for uid fails. Entries are built newest first '''
+        self.nx.failing.add('{}/{}'.format(COLLECTION_PATH, uid))
+        self.assertRaises(ValueError, self.merritt_atom(resume=True).process_feed)
+        self.nx.failing.clear()
+
+    def test_resume(self):
+        self.fail_at('object-002')
+        self.assertTrue(os.path.exists(self.checkpoint_filepath))
+
+        ma = self.process_feed(resume=True)
+
+        self.assertEqual(ma.summary['counters']['entries_resumed'], 2)
+        self.assertEqual(ma.summary['counters']['entries_built'], 3)
+        self.assertEqual(self.entry_ids(self.published()), ['object-{:03d}'.format(i) for i in range(4, -1, -1)])
+        self.assertFalse(os.path.exists(self.checkpoint_filepath))
+
+    def test_changed_object_rebuilt(self):
+        ''' an entry journaled for an object modified since isn't used '''
+        self.fail_at('object-002')
+        self.nx.modify('object-004', datetime.now(dateutil.tz.tzutc()).isoformat())
+
+        ma = self.process_feed(resume=True)
+
+        self.assertEqual(ma.summary['counters']['entries_resumed'], 1)
+        self.assertEqual(ma.summary['counters']['entries_built'], 4)
+
+    def test_checkpoint_only_used_when_resuming(self):
+        self.fail_at('object-002')
+
+        ma = self.process_feed()
+
+        self.assertNotIn('entries_resumed', ma.summary['counters'])
+        self.assertEqual(ma.summary['counters']['entries_built'], 5)
+
+class MetadataCacheTestCase(unittest.TestCase):
+
+    def test_evict_least_recently_used(self):
+        cache = MetadataCache(maxsize=2)
+        cache.put('a', {'uid': 'a'})
+        cache.put('b', {'uid': 'b'})
+        self.assertEqual(cache.get('a'), {'uid': 'a'})
+        cache.put('c', {'uid': 'c'})
+
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), {'uid': 'a'})
+        self.assertEqual(cache.get('c'), {'uid': 'c'})
+        self.assertEqual(cache.stats(), {'size': 2, 'maxsize': 2, 'hits': 3, 'misses': 1, 'evictions': 1})
+
+    def test_replace(self):
+        ''' putting a doc that's already cached doesn't evict anything '''
+        cache = MetadataCache(maxsize=2)
+        cache.put('a', {'uid': 'a'})
+        cache.put('b', {'uid': 'b'})
+        cache.put('a', {'uid': 'a', 'title': 'a'})
+
+        self.assertEqual(cache.get('a'), {'uid': 'a', 'title': 'a'})
+        self.assertEqual(cache.stats()['evictions'], 0)
+
+class MetadataCacheFeedTestCase(FeedTestCase):
+
+    def collection(self):
+        docs = collection_docs(3, components=1)
+        # search results without the file schemas, as pynux gives them
+        self.search_results = dict((doc['uid'], dict(doc, properties={})) for doc in docs)
+        return docs
+
+    def test_components_fetched_once(self):
+        ''' components listed without their file properties are fetched once each, through the cache '''
+        nxql = self.nx.nxql
+        self.nx.nxql = lambda query: (self.search_results[doc['uid']] if 'FROM Document' not in query else doc for doc in nxql(query))
+        fetched = []
+        get_metadata = self.nx.get_metadata
+        def record_get_metadata(uid=None, path=None):
+            fetched.append(uid or path)
+            return get_metadata(uid=uid, path=path)
+        self.nx.get_metadata = record_get_metadata
+
+        ma = self.process_feed(cache_size=2)
+
+        self.assertEqual(sorted(fetched), [COLLECTION_PATH, 'object-000-page-0', 'object-001-page-0', 'object-002-page-0'])
+        self.assertEqual(ma.summary['metadata_cache']['maxsize'], 2)
+        # with links to their files
+        self.assertIn('/object-001-page-0/file:content/object-001-page-0.tif', self.published())
+
+class EntryIdsTestCase(unittest.TestCase):
+
+    def test_duplicate_parent(self):
+        ids = EntryIds()
+        self.assertTrue(ids.add_parent('object'))
+        self.assertFalse(ids.add_parent('object'))
+        self.assertEqual(ids.duplicate_parents, ['object'])
+
+    def test_duplicate_components(self):
+        ''' a component in two entries, or with an entry of its own, is reported '''
+        ids = EntryIds()
+        ids.add_parent('object')
+        self.assertEqual(ids.add_components('object', ['page-1', 'page-2']), [])
+        ids.add_parent('other')
+        self.assertEqual(ids.add_components('other', ['page-2', 'object']), ['page-2', 'object'])
+        self.assertTrue(ids.add_parent('page-1'))
+
+        self.assertEqual(ids.duplicate_components, ['page-2', 'object', 'page-1'])
+        self.assertEqual(ids.stats(), {'entries': 3, 'components': 2, 'duplicate_parents': 0, 'duplicate_components': 3})
+
+class DuplicatesTestCase(FeedTestCase):
+    ''' an object listed twice by Nuxeo '''
+
+    def collection(self):
+        docs = collection_docs(3)
+        return docs + [dict(docs[2])]
+
+    def test_not_stashed(self):
+        for kwargs in ({}, {'stream': True}, {'workers': 2}):
+            self.assertEqual(self.merritt_atom(**kwargs).process_feed(), 'DUPS')
+            self.assertEqual(self.s3.puts, [])
+
+    def test_dedup(self):
+        self.process_feed(dedup=True)
+        self.assertEqual(self.entry_ids(self.published()), ['object-002', 'object-001', 'object-000'])
+
+class FeedArgumentsTestCase(unittest.TestCase):
+
+    def test_feed_kwargs(self):
+        ''' only options given on the command line are passed on '''
+        parser = argparse.ArgumentParser()
+        add_feed_arguments(parser)
+        argv = parser.parse_args(['--dir', 'feeds', '--workers', '4', '--incremental', '--page-size', '1000', '--registry-cache', 'cache'])
+        self.assertEqual(feed_kwargs(argv), {'dir': 'feeds', 'workers': 4, 'incremental': True, 'page_size': 1000, 'registry_cache': 'cache'})
+        self.assertEqual(feed_kwargs(parser.parse_args([])), {})
+
+if __name__ == '__main__':
+    unittest.main()
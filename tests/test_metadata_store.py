@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import shutil
+import tempfile
+import unittest
+from metadata_store import MetadataStore
+
+COMPONENTS = [{'uid': 'page-1', 'title': 'page 1', 'properties': {}}]
+
+class MetadataStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.close()
+        shutil.rmtree(self.cache_dir)
+
+    def open_store(self, **kwargs):
+        store = MetadataStore(self.cache_dir, context='test', **kwargs)
+        self.stores.append(store)
+        return store
+
+    def test_get_stored(self):
+        store = self.open_store()
+        store.put('object', '2016-01-01T00:00:00+00:00', COMPONENTS, b'<entry/>')
+
+        self.assertEqual(store.get_components('object', '2016-01-01T00:00:00+00:00'), COMPONENTS)
+        self.assertEqual(store.get_entry('object', '2016-01-01T00:00:00+00:00'), b'<entry/>')
+        # stored for another version of the object
+        self.assertIsNone(store.get_components('object', '2017-01-01T00:00:00+00:00'))
+        self.assertFalse(store.has_entry('object', '2017-01-01T00:00:00+00:00'))
+
+    def test_other_context(self):
+        self.open_store().put('object', '2016-01-01T00:00:00+00:00', COMPONENTS, b'<entry/>')
+        other = MetadataStore(self.cache_dir, context='other')
+        self.stores.append(other)
+
+        self.assertIsNone(other.get_components('object', '2016-01-01T00:00:00+00:00'))
+        self.assertIsNone(other.get_entry('object', '2016-01-01T00:00:00+00:00'))
+
+    def test_shared_between_stores(self):
+        ''' another process using the same cache_dir can write while a store
+            is open and being read from, and sees what it wrote straight away '''
+        first = self.open_store()
+        second = self.open_store()
+        first.put('object', '2016-01-01T00:00:00+00:00', COMPONENTS)
+        first.get_components('object', '2016-01-01T00:00:00+00:00')
+
+        second.put('other', '2016-01-01T00:00:00+00:00', COMPONENTS)
+        self.assertEqual(second.get_components('object', '2016-01-01T00:00:00+00:00'), COMPONENTS)
+        self.assertEqual(first.get_components('other', '2016-01-01T00:00:00+00:00'), COMPONENTS)
+
+    def test_evict_least_recently_used(self):
+        ''' objects read this run count as used when the store is closed '''
+        store = self.open_store(max_objects=1)
+        store.put('old', '2016-01-01T00:00:00+00:00', COMPONENTS)
+        store.put('new', '2016-01-01T00:00:00+00:00', COMPONENTS)
+        store.get_components('old', '2016-01-01T00:00:00+00:00')
+        store.close()
+        self.stores.remove(store)
+
+        store = self.open_store()
+        self.assertEqual(store.get_components('old', '2016-01-01T00:00:00+00:00'), COMPONENTS)
+        self.assertIsNone(store.get_components('new', '2016-01-01T00:00:00+00:00'))
+
+if __name__ == '__main__':
+    unittest.main()
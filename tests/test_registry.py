@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import re
+import json
+import shutil
+import tempfile
+import unittest
+from registry import RegistryClient, REGISTRY_API_BASE
+
+def collection_record(collection_id, merritt_id=None):
+    return {'resource_uri': '/api/v1/collection/{}/'.format(collection_id),
+            'merritt_id': merritt_id,
+            'merritt_extra_data': 'asset-library/UCX/{}'.format(collection_id) if merritt_id else ''}
+
+class FakeResponse():
+
+    def __init__(self, data):
+        self.content = json.dumps(data)
+
+    def raise_for_status(self):
+        pass
+
+class FakeSession():
+    ''' answers registry API requests for a list of collection records '''
+
+    def __init__(self, collections):
+        self.collections = collections
+        self.urls = []
+
+    def get(self, url):
+        self.urls.append(url)
+        single = re.search(r'/collection/(\d+)/', url)
+        if single:
+            return FakeResponse([c for c in self.collections if c['resource_uri'].endswith('/{}/'.format(single.group(1)))][0])
+
+        limit = int(re.search(r'limit=(\d+)', url).group(1))
+        offset = int(re.search(r'offset=(\d+)', url).group(1))
+        return FakeResponse({'meta': {'total_count': len(self.collections), 'limit': limit},
+                             'objects': self.collections[offset:offset + limit]})
+
+class RegistryClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.session = FakeSession([collection_record(i, 'ark:/13030/m5{}'.format(i) if i % 2 else None) for i in range(1, 251)])
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_collection_fetched_once(self):
+        client = RegistryClient(session=self.session)
+        self.assertEqual(client.get_collection('3')['merritt_id'], 'ark:/13030/m53')
+        client.get_collection('3')
+        self.assertEqual(self.session.urls, ['{}collection/3/?format=json'.format(REGISTRY_API_BASE)])
+
+    def test_disk_cache(self):
+        RegistryClient(cache_dir=self.cache_dir, session=self.session).get_collection('3')
+        RegistryClient(cache_dir=self.cache_dir, session=self.session).get_collection('3')
+        self.assertEqual(len(self.session.urls), 1)
+
+    def test_disk_cache_expires(self):
+        RegistryClient(cache_dir=self.cache_dir, session=self.session).get_collection('3')
+        RegistryClient(cache_dir=self.cache_dir, session=self.session, ttl=0).get_collection('3')
+        self.assertEqual(len(self.session.urls), 2)
+
+    def test_get_collections(self):
+        ''' all list pages are fetched, and the records cached as single collections '''
+        client = RegistryClient(session=self.session)
+        self.assertEqual(len(client.get_collections()), 250)
+        self.assertEqual(sorted(int(re.search(r'offset=(\d+)', url).group(1)) for url in self.session.urls), [0, 100, 200])
+
+        client.get_collection('250')
+        self.assertEqual(len(self.session.urls), 3)
+
+    def test_get_feed_info(self):
+        ''' only collections with a Merritt id get feeds '''
+        feed_info = RegistryClient(session=self.session).get_feed_info()
+        self.assertEqual(len(feed_info), 125)
+        self.assertEqual(feed_info['3'], {'merritt_id': 'ark:/13030/m53', 'nuxeo_endpoint': 'asset-library/UCX/3'})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+import unittest
+from email.utils import formatdate
+import requests
+import resilience
+from resilience import is_transient, retry_after, AdaptiveLimiter, RetryPolicy
+
+def http_error(status, headers=None):
+    response = requests.Response()
+    response.status_code = status
+    response.headers.update(headers or {})
+    return requests.HTTPError(response=response)
+
+class FakeClock():
+    ''' stands in for the time module in resilience, so latencies and cooldowns can be set '''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def gmtime(self):
+        return time.gmtime(self.now)
+
+    def sleep(self, seconds):
+        self.now = self.now + seconds
+
+class TransientTestCase(unittest.TestCase):
+
+    def test_is_transient(self):
+        for status in (429, 500, 502, 503, 504):
+            self.assertTrue(is_transient(http_error(status)))
+        self.assertFalse(is_transient(http_error(404)))
+        self.assertFalse(is_transient(requests.HTTPError()))
+        self.assertTrue(is_transient(requests.ConnectionError()))
+        self.assertTrue(is_transient(requests.Timeout()))
+        self.assertFalse(is_transient(ValueError()))
+
+    def test_retry_after(self):
+        self.assertEqual(retry_after(http_error(503, {'Retry-After': '7'})), 7)
+        self.assertEqual(retry_after(http_error(503, {'Retry-After': '-1'})), 0)
+        self.assertIsNone(retry_after(http_error(503)))
+        self.assertIsNone(retry_after(http_error(503, {'Retry-After': 'soon'})))
+        self.assertIsNone(retry_after(requests.ConnectionError()))
+
+        later = formatdate(time.time() + 30, usegmt=True)
+        self.assertTrue(25 <= retry_after(http_error(503, {'Retry-After': later})) <= 30)
+        earlier = formatdate(time.time() - 30, usegmt=True)
+        self.assertEqual(retry_after(http_error(503, {'Retry-After': earlier})), 0)
+
+class LimiterTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self._time = resilience.time
+        resilience.time = self.clock
+
+    def tearDown(self):
+        resilience.time = self._time
+
+    def request(self, limiter, latency=1.0, error=None):
+        try:
+            with limiter.slot():
+                self.clock.now = self.clock.now + latency
+                if error:
+                    raise error
+        except Exception:
+            pass
+
+    def test_shrink_on_transient_failure(self):
+        limiter = AdaptiveLimiter(maximum=8, cooldown=5)
+        self.request(limiter, error=http_error(503))
+        self.assertEqual(limiter.stats(), {'limit': 4, 'in_flight': 0, 'decreases': 1})
+
+        # at most once per cooldown
+        self.request(limiter, error=http_error(503))
+        self.assertEqual(limiter.stats()['limit'], 4)
+        self.clock.now = self.clock.now + 5
+        self.request(limiter, error=http_error(503))
+        self.assertEqual(limiter.stats()['limit'], 2)
+
+    def test_other_errors_dont_shrink(self):
+        limiter = AdaptiveLimiter(maximum=8)
+        self.request(limiter, error=http_error(404))
+        self.request(limiter, error=ValueError())
+        self.assertEqual(limiter.stats(), {'limit': 8, 'in_flight': 0, 'decreases': 0})
+
+    def test_shrink_on_slow_requests(self):
+        limiter = AdaptiveLimiter(maximum=8, cooldown=0)
+        for i in range(20):
+            self.request(limiter, latency=1.0)
+        self.assertEqual(limiter.stats()['limit'], 8)
+
+        self.request(limiter, latency=20.0)
+        self.assertEqual(limiter.stats()['limit'], 4)
+
+    def test_grow_back(self):
+        ''' by about one for every limit requests that go well, up to the maximum '''
+        limiter = AdaptiveLimiter(maximum=8, cooldown=0)
+        self.request(limiter, error=http_error(503))
+        self.assertEqual(limiter.stats()['limit'], 4)
+
+        for i in range(5):
+            self.request(limiter)
+        self.assertEqual(limiter.stats()['limit'], 5)
+        for i in range(100):
+            self.request(limiter)
+        self.assertEqual(limiter.stats()['limit'], 8)
+
+    def test_minimum(self):
+        limiter = AdaptiveLimiter(maximum=2, minimum=1, cooldown=0)
+        for i in range(3):
+            self.request(limiter, error=http_error(503))
+        self.assertEqual(limiter.stats()['limit'], 1)
+
+class RetryPolicyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self._time = resilience.time
+        resilience.time = self.clock
+
+    def tearDown(self):
+        resilience.time = self._time
+
+    def failing(self, errors, result='done'):
+        ''' a function raising each of errors in turn, then returning result '''
+        errors = list(errors)
+        def function():
+            if errors:
+                raise errors.pop(0)
+            return result
+        return function
+
+    def test_retry_transient(self):
+        policy = RetryPolicy(attempts=3)
+        self.assertEqual(policy.call(self.failing([http_error(503), requests.ConnectionError()])), 'done')
+        self.assertEqual(policy.retries, 2)
+
+    def test_give_up(self):
+        policy = RetryPolicy(attempts=2)
+        self.assertRaises(requests.HTTPError, policy.call, self.failing([http_error(503)] * 2))
+        self.assertRaises(ValueError, policy.call, self.failing([ValueError()]))
+        self.assertEqual(policy.retries, 1)
+
+    def test_waits_as_asked(self):
+        policy = RetryPolicy(attempts=2)
+        started = self.clock.now
+        policy.call(self.failing([http_error(429, {'Retry-After': '12'})]))
+        self.assertEqual(self.clock.now - started, 12)
+
+    def test_listing_outside_limiter(self):
+        ''' a listing doesn't take a slot or count towards latency, but its failures count '''
+        limiter = AdaptiveLimiter(maximum=8, cooldown=0)
+        policy = RetryPolicy(attempts=2, limiter=limiter)
+
+        def listing():
+            self.assertEqual(limiter.stats()['in_flight'], 0)
+            self.clock.now = self.clock.now + 600
+            return ['doc']
+        # usual latency is nil, so a request taking 600s would look like overload
+        policy.call(lambda: None)
+        self.assertEqual(policy.call_listing(listing), ['doc'])
+        self.assertEqual(limiter.stats(), {'limit': 8, 'in_flight': 0, 'decreases': 0})
+
+        policy.call_listing(self.failing([http_error(503)]))
+        self.assertEqual(limiter.stats()['limit'], 4)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -4,7 +4,7 @@
 import sys
 import logging
 import argparse
-from merritt_atom import MerrittAtom
+from merritt_atom import MerrittAtom, add_feed_arguments, feed_kwargs
 
 def main():
 
@@ -19,24 +19,16 @@ def main():
 
     parser = argparse.ArgumentParser(description='refresh merritt atom feeds already stashed on S3')
     parser.add_argument("id", help="registry collection id")
-    parser.add_argument("--pynuxrc", help="rc file for use by pynux")
-    parser.add_argument("--bucket", help="S3 bucket where feed is stashed")
-    parser.add_argument("--dir", help="local directory where feed is written" )
-    parser.add_argument("--nostash", action='store_true', help="write feed to local directory and do not stash on S3")
+    add_feed_arguments(parser)
+    parser.add_argument("--previous-feed", help="local copy of the published feed to use for --incremental instead of fetching it from S3")
 
     argv = parser.parse_args()
 
     collection_id = argv.id
 
-    kwargs = {}
-    if argv.pynuxrc:
-        kwargs['pynuxrc'] = argv.pynuxrc
-    if argv.bucket:
-        kwargs['bucket'] = argv.bucket
-    if argv.dir:
-        kwargs['dir'] = argv.dir
-    if argv.nostash:
-        kwargs['nostash'] = argv.nostash
+    kwargs = feed_kwargs(argv)
+    if argv.previous_feed:
+        kwargs['previous_feed'] = argv.previous_feed
 
     logger.info("collection_id: {}".format(collection_id))
     logger.info("kwargs: {}".format(kwargs))